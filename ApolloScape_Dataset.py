@@ -8,12 +8,16 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import os
+import utils
 os.environ['DGLBACKEND'] = 'pytorch'
 from torchvision import datasets, transforms
 import scipy.sparse as spp
 from dgl.data import DGLDataset
 from sklearn.preprocessing import StandardScaler
 
+_processed = {}  #(raw_dir, test, scale_factor) -> processed sequences, shared by the train/val/test datasets
+SHARED_FIELDS = ['all_adjacency', 'all_mean_xy', 'last_vis_obj', 'object_type', 'info', 'node_features', 'node_labels', 'output_mask',
+                 'train_id_list', 'val_id_list', 'test_id_list']
 
 
 def collate_batch(samples):
@@ -54,9 +58,35 @@ class ApolloScape_DGLDataset(torch.utils.data.Dataset):
 
 
     def process(self):
+        # the pickle is loaded and processed once per (file, test, scale_factor), train/val/test datasets only keep their ids
+        key = (self.raw_dir, self.test, self.scale_factor)
+        if key not in _processed:
+            self.process_all()
+            del self.all_feature  #only its slices below are used, do not keep the whole tensor alive
+            _processed[key] = {name: getattr(self, name) for name in SHARED_FIELDS}
+            # contiguous tensors/arrays in shared memory: DataLoader workers map them instead of copying (also with spawn)
+            for name, value in _processed[key].items():
+                if torch.is_tensor(value):
+                    # info/output_mask are views of all_feature: sharing a view would move the whole storage to shared memory
+                    _processed[key][name] = value.contiguous().clone().share_memory_()
+                else:
+                    _processed[key][name] = np.ascontiguousarray(value)
+        self.__dict__.update(_processed[key])
+
+        if self.test:
+            self.ids = np.array(self.test_id_list)
+        elif self.train_val.lower() == 'train':
+            self.ids = np.array(self.train_id_list)
+        elif self.train_val.lower() == 'val':
+            self.ids = np.array(self.val_id_list)
+        else:
+            self.ids = np.arange(len(self.node_features))
+
+    def process_all(self):
         #process data to graph, labels, and splitting masks
         self.load_data()
         total_num = len(self.all_feature)
+        self.train_id_list, self.val_id_list, self.test_id_list = (np.zeros(0, dtype=int),)*3
         
         self.last_vis_obj=[]   #contains number of visible objects in each sequence of the training, i.e. objects in frame 5
         #para hacer grafos de tamaño variable
@@ -65,6 +95,7 @@ class ApolloScape_DGLDataset(torch.utils.data.Dataset):
                 if self.all_adjacency[idx][i,i] == 0:
                     self.last_vis_obj.append(i)
                     break   
+        self.last_vis_obj = torch.tensor(self.last_vis_obj)
         
         feature_id = [3, 4, 9, 2, 10]   #frame,obj,type,x,y,z,l,w,h,heading, QUITO [visible_mask]
             
@@ -93,39 +124,22 @@ class ApolloScape_DGLDataset(torch.utils.data.Dataset):
         
                 
         #EDGES weights  #5010x120x120[]
-        self.xy_dist=[spatial.distance.cdist(self.node_features[i][:,5,:], self.node_features[i][:,5,:]) for i in range(len(self.all_feature))]  #5010x70x70
+        # distances (over the features of frame 5) are computed only for the edges, in __getitem__
         
         if self.test:
             self.output_mask= self.all_feature[:,:,:,-1]#*mask_car[:,:,:6] #mascara obj (car) visibles en 6º frame (5010,120,6,1)
             #zero_indeces_list = [i for i in range(len(self.output_mask )) if np.all(np.array(self.output_mask.squeeze(-1))==0, axis=(1,2))[i] == True ]
-            self.test_id_list  = list(set(list(range(total_num)))) #- set(zero_indeces_list))
+            self.test_id_list  = np.arange(total_num) #- set(zero_indeces_list))
         else:
             self.output_mask= self.all_feature[:,:,now_history_frame:,-1]#*mask_car #mascara obj (car) visibles en 6º frame (5010,120,6,1)
             self.output_mask = self.output_mask.unsqueeze_(-1)
             # TRAIN VAL SETS
             # Remove empty rows from output mask 
-            zero_indeces_list = [i for i in range(len(self.output_mask )) if np.all(np.array(self.output_mask.squeeze(-1))==0, axis=(1,2))[i] == True ]
-            id_list = list(set(list(range(total_num))) - set(zero_indeces_list))
+            id_list = np.flatnonzero(~np.all(np.array(self.output_mask.squeeze(-1))==0, axis=(1,2)))
             total_valid_num = len(id_list)
             
             self.train_id_list, self.val_id_list = id_list[:round(total_valid_num*0.80)], id_list[round(total_valid_num*0.80):]
 
-            if self.train_val.lower() == 'train':
-                self.node_features = self.node_features[self.train_id_list]  #frame_id, object_id, object_type, position_x, position_y, position_z, object_length, pbject_width, pbject_height, heading
-                self.node_labels = self.node_labels[self.train_id_list]
-                self.output_mask = self.output_mask[self.train_id_list]
-                self.all_adjacency = self.all_adjacency[self.train_id_list]
-                self.all_mean_xy = self.all_mean_xy[self.train_id_list]
-                self.xy_dist = torch.tensor(self.xy_dist)[self.train_id_list]
-                self.last_vis_obj = torch.tensor(self.last_vis_obj)[self.train_id_list]
-            elif self.train_val.lower() == 'val':
-                self.node_features = self.node_features[self.val_id_list]
-                self.node_labels = self.node_labels[self.val_id_list]
-                self.output_mask = self.output_mask[self.val_id_list]
-                self.all_adjacency = self.all_adjacency[self.val_id_list]
-                self.all_mean_xy = self.all_mean_xy[self.val_id_list]
-                self.xy_dist = torch.tensor(self.xy_dist)[self.val_id_list]
-                self.last_vis_obj = torch.tensor(self.last_vis_obj)[self.val_id_list]
 
         #train_id_list = list(np.linspace(0, total_num-1, int(total_num*0.8)).astype(int))
         #val_id_list = list(set(list(range(total_num))) - set(train_id_list))  
@@ -133,25 +147,23 @@ class ApolloScape_DGLDataset(torch.utils.data.Dataset):
 
 
     def __len__(self):
-        return len(self.node_features)
+        return len(self.ids)
 
     def __getitem__(self, idx):
+        idx = self.ids[idx]  #sequence in the shared arrays
         graph = dgl.from_scipy(spp.coo_matrix(self.all_adjacency[idx][:self.last_vis_obj[idx],:self.last_vis_obj[idx]])).int()
         graph = dgl.remove_self_loop(graph)
-        edges_uvs=[np.array([graph.edges()[0][i].numpy(),graph.edges()[1][i].numpy()]) for i in range(graph.num_edges())]
-        rel_types = [(self.object_type[idx][u,5]* self.object_type[idx][v,5])for u,v in edges_uvs]
-        graph = dgl.add_self_loop(graph)
-        if len(rel_types)!=0:
-            rel_types.extend(torch.zeros_like(rel_types[0], dtype=torch.float32) for i in range(graph.num_nodes()))
-        else:
-            rel_types=[torch.zeros(1, dtype=torch.float32) for i in range(graph.num_nodes())]
-        distances = [self.xy_dist[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        distances = [1/(i) if i!=0 else 1 for i in distances]
+        graph = dgl.add_self_loop(graph)  #self-loops go after the edges
+        u, v = graph.edges()
+        u, v = u.long(), v.long()
+        rel_types = (self.object_type[idx][u,5] * self.object_type[idx][v,5]).float()
+        rel_types[-graph.num_nodes():] = 0  #self-loops
+        distances = utils.edge_inverse_distances(self.node_features[idx,:,5], u, v)
         if self.rel_types:
-            distances = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
-            graph.edata['w'] = torch.tensor([[distances[i],rel_types[i]] for i in range(len(rel_types))], dtype=torch.float32)
+            distances = F.softmax(distances, dim=0)
+            graph.edata['w'] = torch.stack([distances, rel_types], dim=1)
         else:
-            graph.edata['w'] = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
+            graph.edata['w'] = F.softmax(distances, dim=0)
 
         #graph.ndata['x']=self.node_features[idx,:self.last_vis_obj[idx]] 
         feats = self.node_features[idx,:self.last_vis_obj[idx]] 
@@ -0,0 +1,88 @@
+import os
+import sys
+import pickle
+
+'''
+Lazy access to the nuScenes devkit: NuScenes and PredictHelper are built on first use, not when a module is imported.
+Loading v1.0-trainval takes tens of seconds and several GB, while the preprocessing only uses a few tables.
+A compact index with just those tables (COMPACT_TABLES) can be written once with
+    python devkit.py /path/to/nuscenes_index.pkl
+and get_nuscenes(index_path=...) then loads it instead of the whole dataset.
+'''
+
+DATAROOT = '/media/14TBDISK/nuscenes'
+VERSION = 'v1.0-trainval'  #850 scenes
+# tables used by PredictHelper, the rasterizers and nuscenes_process.process_scene
+COMPACT_TABLES = ['scene', 'log', 'sample', 'sample_annotation', 'instance', 'attribute']
+
+_nuscenes = None
+_helper = None
+
+
+class CompactNuScenes:
+    '''
+    The part of the NuScenes API used by the preprocessing (tables as lists of records, get, field2token, dataroot),
+    over an index written by save_compact_index.
+    '''
+    def __init__(self, index_path, dataroot=DATAROOT):
+        with open(index_path, 'rb') as reader:
+            index = pickle.load(reader)
+        self.version = index['version']
+        self.dataroot = dataroot
+        self.table_names = list(index['tables'])
+        self._token2ind = {}
+        for table_name, records in index['tables'].items():
+            setattr(self, table_name, records)
+            self._token2ind[table_name] = {record['token']: i for i, record in enumerate(records)}
+
+    def get(self, table_name, token):
+        return getattr(self, table_name)[self._token2ind[table_name][token]]
+
+    def getind(self, table_name, token):
+        return self._token2ind[table_name][token]
+
+    def field2token(self, table_name, field, query):
+        return [record['token'] for record in getattr(self, table_name) if record[field] == query]
+
+
+def save_compact_index(nusc, index_path, tables=COMPACT_TABLES):
+    # records as built by the devkit (sample_annotation has category_name...)
+    index = {'version': nusc.version, 'tables': {table_name: getattr(nusc, table_name) for table_name in tables}}
+    with open(index_path + '.tmp', 'wb') as writer:
+        pickle.dump(index, writer, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def get_nuscenes(version=VERSION, dataroot=DATAROOT, index_path=None):
+    '''
+    NuScenes of this process, built on the first call. If index_path is a compact index of the same version,
+    only its tables are loaded (enough for the preprocessing, not for sample_data / ego_pose queries).
+    '''
+    global _nuscenes
+    if _nuscenes is None:
+        if index_path is not None and os.path.isfile(index_path):
+            _nuscenes = CompactNuScenes(index_path, dataroot)
+            if _nuscenes.version != version:
+                _nuscenes = None
+        if _nuscenes is None:
+            from nuscenes.nuscenes import NuScenes
+            _nuscenes = NuScenes(version, dataroot=dataroot)
+    return _nuscenes
+
+
+def get_helper(**kwargs):
+    '''
+    PredictHelper over get_nuscenes(**kwargs), built on the first call.
+    '''
+    global _helper
+    if _helper is None:
+        from nuscenes.prediction import PredictHelper
+        _helper = PredictHelper(get_nuscenes(**kwargs))
+    return _helper
+
+
+if __name__ == '__main__':
+    # python devkit.py index_path [version]
+    version = sys.argv[2] if len(sys.argv) > 2 else VERSION
+    from nuscenes.nuscenes import NuScenes
+    save_compact_index(NuScenes(version, dataroot=DATAROOT), sys.argv[1])
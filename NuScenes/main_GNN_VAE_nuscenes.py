@@ -316,14 +316,14 @@ def main(args: Namespace):
 
     if args.model_type == 'vae_gated':
         model = VAE_GATED(input_dim_model, args.hidden_dims, z_dim=args.z_dims, output_dim=output_dim, fc=False, dropout=args.dropout, 
-                             ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze)
+                             ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze, map_channels=train_dataset.map_channels)
     elif args.model_type == 'vae_prior':
         model = VAE_GNN_prior(input_dim_model, args.hidden_dims//args.heads, args.z_dims, output_dim, fc=False, dropout=args.dropout, feat_drop=args.feat_drop,
-                        attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze,
+                        attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze, map_channels=train_dataset.map_channels,
                         bn=(args.norm=='bn'), gn=(args.norm=='gn'))
     else:
         model = VAE_GNN(input_dim_model, args.hidden_dims//args.heads, args.z_dims, output_dim, fc=False, dropout=args.dropout, feat_drop=args.feat_drop,
-                        attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze,
+                        attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, ew_dims=args.ew_dims, backbone=args.backbone, freeze=args.freeze, map_channels=train_dataset.map_channels,
                         bn=(args.norm=='bn'), gn=(args.norm=='gn'))
 
     LitGNN_sys = LitGNN(model=model, lr1=args.lr1, lr2=args.lr2,  wd=args.wd, history_frames=history_frames, future_frames= future_frames, beta = args.beta, delta=args.delta,
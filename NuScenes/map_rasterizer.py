@@ -0,0 +1,186 @@
+import os
+import hashlib
+from collections import OrderedDict
+import cv2
+import numpy as np
+from pyquaternion import Quaternion
+from nuscenes.eval.common.utils import quaternion_yaw
+from nuscenes.prediction.input_representation.static_layers import StaticLayerRasterizer, get_lanes_in_radius
+
+'''
+Static map layers rasterized once per map tile instead of once per agent.
+A tile (tile_meters x tile_meters, north up, at the resolution of the rasterizer) keeps
+    layers:    uint8, bit i set where layer_names[i] is present
+    lane_mask: uint8, 1 where a lane is drawn
+    lane_yaw:  float32, yaw of the lane pose drawn in that pixel
+The agent image is an affine crop/rotate of the tiles around the agent (agent heading up, as the devkit
+StaticLayerRasterizer), and the lanes are colored by their yaw difference to the agent (color_by_yaw).
+It approximates the devkit image (nearest-neighbour resampling of global rasters), it is not pixel identical.
+Tiles are kept in memory (LRU) and, if tiles_dir is given, in .npz files shared by processes and runs,
+named after a digest of the map expansion file so tiles of an updated map are not reused.
+'''
+
+
+def yaw_colors(agent_yaw, lane_yaw):
+    # devkit color_by_yaw for arrays: hue = yaw difference + pi, saturation = value = 1
+    angle = (agent_yaw - lane_yaw + np.pi) % (2*np.pi) - np.pi
+    angle = np.where(angle > np.pi, angle - 2*np.pi, angle) + np.pi
+    hue = angle / (2*np.pi)
+    sector = np.floor(hue*6).astype(int) % 6
+    f = hue*6 - np.floor(hue*6)
+    one, zero = np.ones_like(f), np.zeros_like(f)
+    r = np.choose(sector, [one, 1-f, zero, zero, f, one])
+    g = np.choose(sector, [f, one, one, 1-f, zero, zero])
+    b = np.choose(sector, [zero, zero, f, one, one, 1-f])
+    return np.stack([r, g, b], -1) * 255
+
+
+class CachedStaticLayerRasterizer(StaticLayerRasterizer):
+
+    def __init__(self, helper, tiles_dir=None, tile_meters=100, max_tiles=32, **kwargs):
+        super().__init__(helper, **kwargs)
+        self.tiles_dir = tiles_dir
+        self.tile_meters = tile_meters
+        self.tile_pixels = int(round(tile_meters / self.resolution))
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.map_digests = {}
+        if tiles_dir is not None:
+            os.makedirs(tiles_dir, exist_ok=True)
+
+    def map_digest(self, map_name):
+        if map_name not in self.map_digests:
+            h = hashlib.sha1()
+            with open(self.maps[map_name].json_fname, 'rb') as reader:
+                for chunk in iter(lambda: reader.read(1<<20), b''):
+                    h.update(chunk)
+            self.map_digests[map_name] = h.hexdigest()[:12]
+        return self.map_digests[map_name]
+
+    def tile_path(self, map_name, tx, ty):
+        return os.path.join(self.tiles_dir, f'{map_name}_{self.map_digest(map_name)}_{self.resolution}_{self.tile_meters}_{"_".join(self.layer_names)}_{tx}_{ty}.npz')
+
+    def rasterize_tile(self, map_name, tx, ty):
+        x0, y0, size = tx*self.tile_meters, ty*self.tile_meters, self.tile_meters
+        patch_box = (x0 + size/2, y0 + size/2, size, size)
+        masks = self.maps[map_name].get_map_mask(patch_box, 0, self.layer_names, canvas_size=(self.tile_pixels, self.tile_pixels))
+        layers = np.zeros((self.tile_pixels, self.tile_pixels), dtype=np.uint8)
+        for i, mask in enumerate(masks):
+            layers |= (mask[::-1] > 0).astype(np.uint8) << i   #rows of the mask go south to north
+
+        # lanes (and lane connectors) near the tile, drawn in global coordinates like draw_lanes_on_image
+        lane_mask = np.zeros_like(layers)
+        lane_yaw = np.zeros(layers.shape, dtype=np.float32)
+        lanes = get_lanes_in_radius(x0 + size/2, y0 + size/2, size/2 + 5, 1, self.maps[map_name])
+        for poses_along_lane in lanes.values():
+            poses = np.array(poses_along_lane, dtype=float).reshape(-1, 3)
+            cols = ((poses[:, 0] - x0) / self.resolution).astype(int)
+            rows = ((y0 + size - poses[:, 1]) / self.resolution).astype(int)
+            for i in range(len(poses)-1):
+                start, end = (int(cols[i]), int(rows[i])), (int(cols[i+1]), int(rows[i+1]))
+                cv2.line(lane_mask, start, end, 1, thickness=5)
+                cv2.line(lane_yaw, start, end, float(poses[i, 2]), thickness=5)
+        return {'layers': layers, 'lane_mask': lane_mask, 'lane_yaw': lane_yaw}
+
+    def get_tile(self, map_name, tx, ty):
+        key = (map_name, tx, ty)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        path = self.tile_path(map_name, tx, ty) if self.tiles_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            with np.load(path) as data:
+                tile = {name: data[name] for name in data.files}
+        else:
+            tile = self.rasterize_tile(map_name, tx, ty)
+            if path is not None:
+                np.savez(path + '.tmp.npz', **tile)
+                os.replace(path + '.tmp.npz', path)
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def crop(self, instance_token, sample_token):
+        '''
+        Tile rasters cut around the agent (agent heading up, meters_ahead/behind/left/right around it).
+        :return: dict name -> (rows, cols) crop of each tile raster, agent yaw
+        '''
+        sample_annotation = self.helper.get_sample_annotation(instance_token, sample_token)
+        map_name = self.helper.get_map_name_from_sample_token(sample_token)
+        x, y = sample_annotation['translation'][:2]
+        yaw = quaternion_yaw(Quaternion(sample_annotation['rotation']))
+
+        # tiles covering every pixel of the agent image
+        radius = np.hypot(max(self.meters_ahead, self.meters_behind), max(self.meters_left, self.meters_right)) + 1
+        tx0, tx1 = int(np.floor((x - radius) / self.tile_meters)), int(np.floor((x + radius) / self.tile_meters))
+        ty0, ty1 = int(np.floor((y - radius) / self.tile_meters)), int(np.floor((y + radius) / self.tile_meters))
+        tiles = [[self.get_tile(map_name, tx, ty) for tx in range(tx0, tx1+1)] for ty in range(ty1, ty0-1, -1)]  #north row first
+        mosaic = {name: np.block([[tile[name] for tile in row] for row in tiles]) for name in tiles[0][0]}
+
+        # output pixel (col, row) -> mosaic pixel: agent at row meters_ahead, col meters_left, heading up
+        rows = int((self.meters_ahead + self.meters_behind) / self.resolution)
+        cols = int((self.meters_left + self.meters_right) / self.resolution)
+        cos, sin = np.cos(yaw), np.sin(yaw)
+        agent_row, agent_col = self.meters_ahead / self.resolution, self.meters_left / self.resolution
+        origin_col = (x - tx0*self.tile_meters) / self.resolution
+        origin_row = ((ty1+1)*self.tile_meters - y) / self.resolution
+        warp = np.array([[sin, -cos, origin_col + agent_row*cos - agent_col*sin],
+                         [cos, sin, origin_row - agent_row*sin - agent_col*cos]])
+        crop = {name: cv2.warpAffine(value, warp, (cols, rows), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+                for name, value in mosaic.items()}
+        return crop, yaw
+
+    def make_representation(self, instance_token, sample_token):
+        '''
+        Approximation of StaticLayerRasterizer.make_representation: the layers and lanes are rasterized once in global
+        (north up) tiles and rotated to the agent with a nearest-neighbour affine warp, so pixels along the borders of
+        the polygons and lanes can differ from the devkit image (see tests/test_map_rasterizer.py for the tolerance).
+        '''
+        crop, yaw = self.crop(instance_token, sample_token)
+        # later layers are drawn over the previous ones (Rasterizer.combine), lanes last
+        image = np.zeros(crop['layers'].shape + (3,), dtype=np.uint8)
+        for i, color in enumerate(self.colors):
+            if any(color):
+                image[(crop['layers'] >> i) & 1 == 1] = color
+        lanes = crop['lane_mask'] == 1
+        lane_colors = yaw_colors(yaw, crop['lane_yaw'][lanes]).astype(np.uint8)
+        image[lanes] = np.where(lane_colors.any(-1, keepdims=True), lane_colors, image[lanes])
+        return image
+
+    def make_layer_masks(self, instance_token, sample_token):
+        '''
+        One binary mask per map layer instead of a color image: (len(layer_names)+1, rows, cols) bool, lanes last.
+        '''
+        crop, _ = self.crop(instance_token, sample_token)
+        layers = [(crop['layers'] >> i) & 1 == 1 for i in range(len(self.layer_names))]
+        return np.stack(layers + [crop['lane_mask'] == 1])
+
+
+# Encodings of the stored agent maps (map_encoding of nuscenes_process), decoded in batch by nuscenes_Dataset.decode_maps
+#   rgb:   (112,112,3) uint8, the devkit InputRepresentation image
+#   gray:  (112,112) uint8, its luminance (as transforms.Grayscale), 3x smaller
+#   masks: (n_layers,112,14) uint8, one bit per pixel and layer (drivable_area, ped_crossing, walkway, lanes, agents)
+#          -> 5 map channels: train with --backbone resnet_gray or map_encoder (map_channels of the models), not the rgb resnet
+MAP_ENCODINGS = ['rgb', 'gray', 'masks']
+
+
+def encode_images(images, encoding):
+    '''
+    :images: (N,112,112,3) uint8 rgb maps
+    '''
+    if encoding == 'gray':
+        return np.round(images @ np.array([0.299, 0.587, 0.114])).astype(np.uint8)
+    return images
+
+
+def pack_masks(masks, size=112):
+    '''
+    :masks: (N, n_layers, rows, cols) bool, resized to size x size (a pixel is set if most of its area is) and bit-packed along the rows
+    '''
+    masks = np.asarray(masks, dtype=np.float32)
+    resized = np.zeros((len(masks), masks.shape[1], size, size), dtype=bool)
+    for i, agent_masks in enumerate(masks):
+        for j, mask in enumerate(agent_masks):
+            resized[i, j] = cv2.resize(mask, (size, size), interpolation=cv2.INTER_AREA) >= 0.5
+    return np.packbits(resized, axis=-1)
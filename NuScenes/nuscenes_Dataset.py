@@ -10,10 +10,13 @@ from torch.utils.data import DataLoader
 from torchvision import transforms, utils
 from torchvision.transforms import functional as trans_fn
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import utils
+import data_store
+import graph_cache
 os.environ['DGLBACKEND'] = 'pytorch'
 from torchvision import transforms
-import scipy.sparse as spp
 from dgl.data import DGLDataset
 from sklearn.preprocessing import StandardScaler
 import cv2
@@ -28,12 +31,27 @@ total_frames = history_frames + future_frames #2s of history + 6s of prediction
 max_num_objects = 150 
 total_feature_dimension = 16
 base_path = '/media/14TBDISK/sandra/nuscenes_processed'
-map_base_path = os.path.join(base_path, 'hd_maps_step2_4parked_2s')
+
+def decode_maps(maps):
+    '''
+    Stored uint8 maps of a batch (see map_rasterizer.MAP_ENCODINGS) -> normalized float maps [N,C,112,112]
+        rgb   [N,112,112,3]      -> [N,3,112,112]
+        gray  [N,112,112]        -> [N,1,112,112]
+        masks [N,n_layers,112,14] -> [N,n_layers,112,112], one 0/1 channel per layer
+    '''
+    if maps.dim() == 3:
+        return (maps.unsqueeze(1).float() / 255 - 0.35) / 0.43
+    if maps.shape[-1] == 3:
+        maps = maps.permute(0,3,1,2).float() / 255
+        return (maps - torch.tensor([0.312,0.307,0.377]).view(1,3,1,1)) / torch.tensor([0.447,0.447,0.471]).view(1,3,1,1)
+    bits = torch.arange(7, -1, -1, dtype=torch.uint8)
+    return ((maps.unsqueeze(-1) >> bits) & 1).flatten(start_dim=-2).float()
+
 
 def collate_batch(samples):
     graphs, masks, feats, gt, maps = map(list, zip(*samples))  # samples is a list of tuples
     if maps[0] is not None:
-        maps = torch.vstack(maps)
+        maps = decode_maps(torch.vstack(maps))  # unpacked once per batch
     masks = torch.vstack(masks)
     feats = torch.vstack(feats)
     gt = torch.vstack(gt).float()
@@ -56,10 +74,11 @@ def collate_batch(samples):
 class nuscenes_Dataset(torch.utils.data.Dataset):
 
     def __init__(self, train_val_test='train', history_frames=history_frames, future_frames=future_frames, 
-                    rel_types=True, challenge_eval=False):
+                    rel_types=True, challenge_eval=False, graph_cache=False):
         '''
             :classes:   categories to take into account
             :rel_types: wether to include relationship types in edge features 
+            :graph_cache: build the graphs once (graph_cache.py) and load them in __getitem__
         '''
         self.train_val_test=train_val_test
         self.history_frames = history_frames
@@ -69,26 +88,39 @@ class nuscenes_Dataset(torch.utils.data.Dataset):
             train_val_test = 'train_filter'
         elif train_val_test == 'test':
             train_val_test = 'val'
-        self.raw_dir = os.path.join(base_path, 'nuscenes_step2_seq_'+ train_val_test +'.pkl' )
+        self.raw_dir = os.path.join(base_path, 'nuscenes_step2_seq_'+ train_val_test )  #store dir, see data_store.py
         if challenge_eval: 
-            self.raw_dir = os.path.join(base_path,'nuscenes_challenge_global_step2_test.pkl')
+            self.raw_dir = os.path.join(base_path,'nuscenes_challenge_global_step2_test')
         self.challenge_eval = challenge_eval
-        self.transform = transforms.Compose(
-                            [
-                                transforms.ToTensor(),
-                                #transforms.Grayscale(),
-                                transforms.Normalize((0.312,0.307,0.377), (0.447,0.447,0.471))
-                                #transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))   #Imagenet
-                                #transforms.Normalize((0.35), (0.43)), 
-                            ]
-                        )
+        self.graph_cache = graph_cache
         self.load_data()
         self.process()        
 
     def load_data(self):
-        with open(self.raw_dir, 'rb') as reader:
-            [all_feature, self.all_adjacency, self.all_mean_xy, self.all_tokens]= pickle.load(reader)
-        self.all_feature=torch.from_numpy(all_feature).type(torch.float32)
+        if not data_store.is_store(self.raw_dir):
+            # old <raw_dir>.pkl + hd_maps_*/<sample_token>.pkl outputs are not converted, the maps are rasterized again
+            old = ' (' + self.raw_dir + '.pkl is in the old pickle format, no longer read)' if os.path.isfile(self.raw_dir + '.pkl') else ''
+            raise FileNotFoundError(f'No sequence store in {self.raw_dir}{old}: run NuScenes/nuscenes_process.py to build it')
+        # memory-mapped, sequences are read in __getitem__ (store shared with the other splits, e.g. val/test)
+        store = data_store.shared_store(self.raw_dir)
+        self.all_feature = store['feature']  #(N,V,T,C)
+        self.all_mean_xy = store['mean_xy']
+        self.all_tokens = store['tokens']  #int32 ids into token_table (instance, sample) per visible object
+        self.token_table = store.get('token_table')  #None in stores that keep the token strings
+        self.all_edge_src = store['edge_src']  #graph edges (sparse, no self-loops)
+        self.all_edge_dst = store['edge_dst']
+        self.map_encoding = store['meta'].get('map_encoding', 'rgb')
+        if 'map_table' in store:
+            # rgb/gray maps: deduplicated static layers (map_table) + overlay of the pixels that differ (agents), see load_maps
+            self.all_maps = None
+            self.map_table = store['map_table']
+            self.all_map_static = store['map_static']
+            self.all_overlay_pixels = store['overlay_pixels']
+            self.all_overlay_values = store['overlay_values']
+        else:
+            self.all_maps = store['maps']  #HD maps of the visible objects, all_maps[idx] is a (N_agents,...) uint8 slice of one memmap
+        # channels of the maps given by decode_maps, map_channels of the models (in_channels of the map backbone)
+        self.map_channels = {'rgb': 3, 'gray': 1}.get(self.map_encoding) or self.all_maps.values.shape[1]
         '''
         if self.train_val_test == 'test':  
             self.all_feature= self.all_feature[:1000]
@@ -108,7 +140,7 @@ class nuscenes_Dataset(torch.utils.data.Dataset):
         INPUT:
             :all_feature:   x,y (global zero-centralized),heading,velx,vely,accx,accy,head_rate, type, l,w,h, frame_id, scene_id, mask, num_visible_objects (14)
             :all_mean_xy:   mean_xy per sequence for zero centralization
-            :all_adjacency: Adjacency matrix per sequence for building graph
+            :all_edge_src/dst: Edges per sequence for building graph (self-loops added here)
             :all_tokens:    Instance token, scene token
         RETURNS:
             :node_feats :  x_y_global, past_x_y, heading,vel,accel,heading_change_rate, type (2+8+5 = 15 in_features)
@@ -120,13 +152,7 @@ class nuscenes_Dataset(torch.utils.data.Dataset):
         total_num = len(self.all_feature)
         print(f"{self.train_val_test} split has {total_num} sequences.")
         now_history_frame=self.history_frames-1
-        feature_id = list(range(0,9)) 
-        self.track_info = self.all_feature[:,:,:,13:15]
-        self.object_type = self.all_feature[:,:,now_history_frame,8].int()
-        self.scene_ids = self.all_feature[:,0,now_history_frame,-3].numpy()
-        self.all_scenes = np.unique(self.scene_ids)
-        self.num_visible_object = self.all_feature[:,0,now_history_frame,-1].int()   #Max=108 (train), 104(val), 83 (test)  #En filter 82 max
-        self.output_mask= self.all_feature[:,:,self.history_frames:,-2].unsqueeze_(-1)
+        self.feature_id = list(range(0,9)) 
         
         #rescale_xy[:,:,:,0] = torch.max(abs(self.all_feature[:,:,:,0]))  
         #rescale_xy[:,:,:,1] = torch.max(abs(self.all_feature[:,:,:,1]))  
@@ -134,53 +160,86 @@ class nuscenes_Dataset(torch.utils.data.Dataset):
         #self.all_feature[:,:,:self.history_frames,:2] = self.all_feature[:,:,:self.history_frames,:2]/rescale_xy
 
         ###### Normalize with training statistics to have 0 mean and std=1 #######
-        self.node_features = self.all_feature[:,:,:self.history_frames,feature_id] 
-        #self.node_features[:,:,:,:2] = (self.node_features[:,:,:,:2] - 0.1579) / 12.4354
-        self.node_labels = self.all_feature[:,:,self.history_frames:,:2] #- 0.1579) / 12.4354
-        #self.node_labels[:,:,:,2:] = ( self.node_labels[:,:,:,2:] - 0.2 ) / 1.79     # Normalize heading (mean 0.2 std 1.79) for z0 loss.
+        #node_features[:,:,:2] = (node_features[:,:,:2] - 0.1579) / 12.4354
+        #node_labels[:,:,2:] = ( node_labels[:,:,2:] - 0.2 ) / 1.79     # Normalize heading (mean 0.2 std 1.79) for z0 loss.
+
+        # distances are computed only for the edges of each graph, in build_graph
 
-        self.xy_dist=[spatial.distance.cdist(self.all_feature[i][:,now_history_frame,:2], self.node_features[i][:,now_history_frame,:2]) for i in range(len(self.all_feature))]  #5010x70x70
+        self.graphs = None
+        if self.graph_cache:
+            params = {'dataset': 'nuscenes', 'history_frames': self.history_frames, 'rel_types': self.types}
+            self.graphs = graph_cache.load_or_build(self.raw_dir, params, self.make_graph, len(self.all_feature))
         
+    def token_strings(self, ids):
+        '''
+        Token ids (any shape) -> instance/sample token strings, only needed to write submissions or query the devkit.
+        '''
+        if self.token_table is None:
+            return np.asarray(ids)
+        return self.token_table[np.asarray(ids)]
+
+    def load_maps(self, idx):
+        '''
+        uint8 maps of the visible objects of sequence idx, [N_agents,...] (see map_rasterizer.MAP_ENCODINGS)
+        '''
+        if self.all_maps is not None:
+            return np.array(self.all_maps[idx])
+        maps = self.map_table[np.asarray(self.all_map_static[idx])]  #copy of the static layers
+        pixels, values = self.all_overlay_pixels[idx], self.all_overlay_values[idx]
+        maps.reshape(len(maps), maps.shape[1]*maps.shape[2], -1)[pixels[:,0], pixels[:,1]] = values
+        return maps
+
     def __len__(self):
             return len(self.all_feature)
 
     def __getitem__(self, idx):        
-        graph = dgl.from_scipy(spp.coo_matrix(self.all_adjacency[idx][:self.num_visible_object[idx],:self.num_visible_object[idx]])).int()
-        object_type = self.object_type[idx,:self.num_visible_object[idx]]
-        # Compute relation types
-        edges_uvs=[np.array([graph.edges()[0][i].numpy(),graph.edges()[1][i].numpy()]) for i in range(graph.num_edges())]
-        rel_types = [torch.zeros(1, dtype=torch.int) if u==v else (object_type[u]*object_type[v]) for u,v in edges_uvs]
-        
-        # Compute distances among neighbors
-        distances = [self.xy_dist[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        #rel_vels = [self.vel_l2[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        distances = [1/(i) if i!=0 else 1 for i in distances]
-        if self.types:
-            #rel_vels =  F.softmax(torch.tensor(rel_vels, dtype=torch.float32), dim=0)
-            distances = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
-            graph.edata['w'] = torch.tensor([[distances[i],rel_types[i]] for i in range(len(rel_types))], dtype=torch.float32)
-        else:
-            graph.edata['w'] = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
+        feature = torch.from_numpy(np.array(self.all_feature[idx,:,:self.history_frames+self.future_frames])).type(torch.float32)  #(V,T,C)
+        num_visible_object = int(feature[0,self.history_frames-1,-1])   #Max=108 (train), 104(val), 83 (test)  #En filter 82 max
+        scene_id = int(feature[0,self.history_frames-1,-3])
+        graph = self.graphs[idx] if self.graphs is not None else self.build_graph(idx, feature, num_visible_object)
 
+        feats = feature[:num_visible_object,:self.history_frames,self.feature_id]
+        gt = feature[:num_visible_object,self.history_frames:,:2]
+        output_mask = feature[:num_visible_object,self.history_frames:,-2:-1]
 
-        feats = self.node_features[idx, :self.num_visible_object[idx]]
-        gt = self.node_labels[idx, :self.num_visible_object[idx]]
-        output_mask = self.output_mask[idx, :self.num_visible_object[idx]]
-
-        
-        sample_token=str(self.all_tokens[idx][0,1])
-        with open(os.path.join(map_base_path, sample_token + '.pkl'), 'rb') as reader:
-            maps = pickle.load(reader)  # [N_agents][3, 112,112] list of tensors
         
-        maps=torch.vstack([self.transform(map_i).unsqueeze(0) for map_i in maps])
+        maps = torch.from_numpy(self.load_maps(idx))  # [N_agents,...] uint8, decoded in collate_batch (decode_maps)
         #img=((maps[0]-maps[0].min())*255/(maps[0].max()-maps[0].min())).numpy().transpose(1,2,0)
         #cv2.imwrite('input_276_0_gray'+sample_token+'.png',cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
         
         if self.challenge_eval:
-            return graph, output_mask, feats, gt, self.all_tokens[idx], int(self.scene_ids[idx]), self.all_mean_xy[idx,:2], maps            
+            return graph, output_mask, feats, gt, np.array(self.all_tokens[idx]), scene_id, self.all_mean_xy[idx,:2], maps            
             
         return graph, output_mask, feats, gt, maps
 
+    def make_graph(self, idx):
+        feature = torch.from_numpy(np.array(self.all_feature[idx,:,:self.history_frames])).type(torch.float32)
+        return self.build_graph(idx, feature, int(feature[0,self.history_frames-1,-1]))
+
+    def build_graph(self, idx, feature, num_visible_object):
+        '''
+        Graph of sequence idx with self-loops and its edge data w (softmax of inverse distances [, relation type])
+        '''
+        graph = dgl.graph((torch.from_numpy(np.array(self.all_edge_src[idx])), torch.from_numpy(np.array(self.all_edge_dst[idx]))), 
+                          num_nodes=num_visible_object, idtype=torch.int32)
+        graph = dgl.add_self_loop(graph)
+        u, v = graph.edges()
+        u, v = u.long(), v.long()
+        object_type = feature[:num_visible_object,self.history_frames-1,8].int()
+        # Compute relation types
+        rel_types = torch.where(u == v, torch.zeros_like(u), (object_type[u] * object_type[v]).long())
+        
+        # Compute distances among neighbors
+        distances = utils.edge_inverse_distances(feature[:num_visible_object,self.history_frames-1,:2], u, v)
+        #rel_vels = utils.edge_inverse_distances(feature[:num_visible_object,self.history_frames-1,3:5], u, v)
+        if self.types:
+            #rel_vels =  F.softmax(rel_vels, dim=0)
+            distances = F.softmax(distances, dim=0)
+            graph.edata['w'] = torch.stack([distances, rel_types.float()], dim=1)
+        else:
+            graph.edata['w'] = F.softmax(distances, dim=0)
+        return graph
+
 if __name__ == "__main__":
     
     val_dataset = nuscenes_Dataset(train_val_test='val', challenge_eval=True)  #3509
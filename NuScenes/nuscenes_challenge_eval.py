@@ -96,10 +96,9 @@ class LitGNN(pl.LightningModule):
             prediction_all_agents.append(np.stack([pred_x, pred_y],axis=-1))
 
         prediction_all_agents = np.array(prediction_all_agents)
-        for token in tokens_eval:
-            if str(token[0]+'_'+token[1]) in self.prediction_scenes['scene-'+ str(scene_id).zfill(4)]:
-                idx = np.where(np.array(tokens_eval)== token[0])[0][0]
-                instance, sample = token
+        # tokens are int32 ids (row of the agent = idx), strings are only needed for the submission
+        for idx, (instance, sample) in enumerate(self.test_dataset.token_strings(tokens_eval)):
+            if str(instance+'_'+sample) in self.prediction_scenes['scene-'+ str(scene_id).zfill(4)]:
                 pred = Prediction(str(instance), str(sample), prediction_all_agents[:,idx], np.ones(25)*1/25)  #need the pred to have 2d
                 self.challenge_predictions.append(pred.serialize())
     
@@ -116,11 +115,11 @@ def main(args: Namespace):
                         future_frames=future_frames, challenge_eval=True)  #25 seq 2 scenes 103, 916
 
     if args.model_type == 'vae_gated':
-        model = VAE_GATED(input_dim_model, args.hidden_dims, z_dim=args.z_dims, output_dim=output_dim, fc=False, dropout=args.dropout,  ew_dims=args.ew_dims)
+        model = VAE_GATED(input_dim_model, args.hidden_dims, z_dim=args.z_dims, output_dim=output_dim, fc=False, dropout=args.dropout,  ew_dims=args.ew_dims, map_channels=test_dataset.map_channels)
     else:
         model = VAE_GNN(input_dim_model, args.hidden_dims//args.heads, args.z_dims, output_dim, fc=False, dropout=args.dropout, 
                         feat_drop=args.feat_drop, attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, 
-                        ew_dims=args.ew_dims, backbone=args.backbone)
+                        ew_dims=args.ew_dims, backbone=args.backbone, map_channels=test_dataset.map_channels)
     LitGNN_sys = LitGNN(model=model, history_frames=history_frames, future_frames= future_frames, train_dataset=None, val_dataset=None,
                  test_dataset=test_dataset, rel_types=args.ew_dims>1, scale_factor=args.scale_factor)
       
@@ -4,18 +4,28 @@ import numpy as np
 from scipy import spatial 
 import pickle
 import torch 
-from nuscenes.nuscenes import NuScenes
 from nuscenes.map_expansion.map_api import NuScenesMap
 from nuscenes.eval.prediction.splits import get_prediction_challenge_split
 from nuscenes.eval.prediction.config import load_prediction_config
-from nuscenes.prediction import PredictHelper
 from nuscenes.utils.splits import create_splits_scenes
 import pandas as pd
 from collections import defaultdict
 from pyquaternion import Quaternion
 from torchvision import transforms
-
-from nuscenes.prediction.input_representation.static_layers import StaticLayerRasterizer
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_store
+import graph_utils
+import geometry
+import profiling
+import time
+import cProfile
+import argparse
+import multiprocessing
+import hashlib
+import glob
+
+import map_rasterizer
+import devkit
 from nuscenes.prediction.input_representation.agents import AgentBoxesWithFadedHistory
 from nuscenes.prediction.input_representation.interface import InputRepresentation
 from nuscenes.prediction.input_representation.combinators import Rasterizer
@@ -34,18 +44,43 @@ future = 6
 history_frames = history*FREQUENCY
 future_frames = future*FREQUENCY
 total_frames = history_frames + future_frames #2s of history + 6s of prediction
+step = 2 #iterate over 2s
+cache_version = 6 #bump when the processing code changes the output, invalidates the cache
+profiler = profiling.StageProfiler()
 
 # This is the path where you stored your copy of the nuScenes dataset.
 DATAROOT = '/media/14TBDISK/nuscenes'
-nuscenes = NuScenes('v1.0-trainval', dataroot=DATAROOT)   #850 scenes
-# Helper for querying past and future data for an agent.
-helper = PredictHelper(nuscenes)
+VERSION = 'v1.0-trainval'  #850 scenes
 base_path = '/media/14TBDISK/sandra/nuscenes_processed'
-base_path_map = os.path.join(base_path, 'hd_maps_step2_4parked_2s')
+devkit_index_path = os.path.join(base_path, 'nuscenes_index_' + VERSION + '.pkl')  #optional compact devkit index, see devkit.py
+
+# devkit objects, built on first use (once per process) by these accessors
+_input_representation = None
+
+
+def get_nuscenes():
+    return devkit.get_nuscenes(VERSION, DATAROOT, index_path=devkit_index_path)
+
+
+def get_helper():
+    # Helper for querying past and future data for an agent.
+    return devkit.get_helper(version=VERSION, dataroot=DATAROOT, index_path=devkit_index_path)
+
+
+def get_input_representation():
+    global _input_representation
+    if _input_representation is None:
+        # static layers are cut from cached map tiles instead of rasterized for every agent
+        static_layer_rasterizer = map_rasterizer.CachedStaticLayerRasterizer(get_helper(), tiles_dir=os.path.join(base_path, 'map_tiles'))
+        agent_rasterizer = AgentBoxesWithFadedHistory(get_helper(), seconds_of_history=2)
+        _input_representation = InputRepresentation(static_layer_rasterizer, agent_rasterizer, Rasterizer())
+    return _input_representation
+
+
+def init_worker():
+    # forked workers inherit the devkit of the main process, spawned ones load their own (once) before the first scene
+    get_input_representation()
 
-static_layer_rasterizer = StaticLayerRasterizer(helper)
-agent_rasterizer = AgentBoxesWithFadedHistory(helper, seconds_of_history=2)
-input_representation = InputRepresentation(static_layer_rasterizer, agent_rasterizer, Rasterizer())
 transform = transforms.Compose(
                             [
                                 #transforms.ToTensor(),
@@ -63,82 +98,17 @@ PED_PED_RADIUS= 10
 PED_BIC_RADIUS= 15
 BIC_BIC_RADIUS= 25
 neighbor_distance = VEH_VEH_RADIUS
+# node types: 1 vehicle, 2 pedestrian, 3 bicycle/motorcycle (see process_scene)
+neighbor_radii = {(1,1): VEH_VEH_RADIUS, (1,2): VEH_PED_RADIUS, (1,3): VEH_BIC_RADIUS,
+                  (2,2): PED_PED_RADIUS, (2,3): PED_BIC_RADIUS, (3,3): BIC_BIC_RADIUS}
 
 
-def pol2cart(th, r):
-    """
-    Transform polar to cartesian coordinates.
-    :param th: Nx1 ndarray
-    :param r: Nx1 ndarray
-    :return: Nx2 ndarray
-    """
-
-    x = np.multiply(r, np.cos(th))
-    y = np.multiply(r, np.sin(th))
-
-    cart = np.array([x, y]).transpose()
-    return cart
-
-def cart2pol(cart):
-    """
-    Transform cartesian to polar coordinates.
-    :param cart: Nx2 ndarray
-    :return: 2 Nx1 ndarrays
-    """
-    if cart.shape == (2,):
-        cart = np.array([cart])
-
-    x = cart[:, 0]
-    y = cart[:, 1]
-
-    th = np.arctan2(y, x)
-    r = np.sqrt(np.power(x, 2) + np.power(y, 2))
-    return th, r
-
-def calculate_rotated_bboxes(center_points_x, center_points_y, length, width, rotation=0):
-    """
-    Calculate bounding box vertices from centroid, width and length.
-    :param centroid: center point of bbox
-    :param length: length of bbox
-    :param width: width of bbox
-    :param rotation: rotation of main bbox axis (along length)
-    :return:
-    """
-
-    centroid = np.array([center_points_x, center_points_y]).transpose()
-
-    centroid = np.array(centroid)
-    if centroid.shape == (2,):
-        centroid = np.array([centroid])
-
-    # Preallocate
-    data_length = centroid.shape[0]
-    rotated_bbox_vertices = np.empty((data_length, 4, 2))
-
-    # Calculate rotated bounding box vertices
-    rotated_bbox_vertices[:, 0, 0] = -length / 2
-    rotated_bbox_vertices[:, 0, 1] = -width / 2
-
-    rotated_bbox_vertices[:, 1, 0] = length / 2
-    rotated_bbox_vertices[:, 1, 1] = -width / 2
-
-    rotated_bbox_vertices[:, 2, 0] = length / 2
-    rotated_bbox_vertices[:, 2, 1] = width / 2
-
-    rotated_bbox_vertices[:, 3, 0] = -length / 2
-    rotated_bbox_vertices[:, 3, 1] = width / 2
-
-    for i in range(4):
-        th, r = cart2pol(rotated_bbox_vertices[:, i, :])
-        rotated_bbox_vertices[:, i, :] = pol2cart(th + rotation, r).squeeze()
-        rotated_bbox_vertices[:, i, :] = rotated_bbox_vertices[:, i, :] + centroid
-
-    return rotated_bbox_vertices
-
-def process_tracks(tracks, start_frame, end_frame, current_frame):
+def process_tracks(tracks, start_frame, end_frame, current_frame, row_index, row_feature):
     '''
         Tracks: a list of (n_frames ~40f = 20s) tracks_per_frame ordered by frame.
                 Each row (track) contains a dict, where each key corresponds to an array of data from all agents in that frame.
+        row_index: (n_frames, n_instances) row of each agent of the scene in each frame, -1 if absent (see process_scene)
+        row_feature: (n_rows, 14) position, motion, info_agent, info_sequence of every row of the scene
         
         Returns data processed for a sequence of 8s (2s of history, 6s of labels)
     '''
@@ -153,11 +123,9 @@ def process_tracks(tracks, start_frame, end_frame, current_frame):
     # You can convert global coords to local frame with: helper.convert_global_coords_to_local(coords,starting_annotation['translation'], starting_annotation['rotation'])
     # x_global y_global are centralized in 0 taking into account all objects positions in the current frame
     xy = tracks[current_frame]['position'][:, :2].astype(float)
-    # Compute distance between any pair of objects
-    dist_xy = spatial.distance.cdist(xy, xy)  
-    # If their distance is less than ATTENTION RADIUS (neighbor_distance), we regard them as neighbors.
-    neighbor_matrix = np.zeros((max_num_objects, max_num_objects))
-    neighbor_matrix[:num_visible_object,:num_visible_object] = (dist_xy<neighbor_distance).astype(int)
+    # If their distance is less than the ATTENTION RADIUS of their pair of types, we regard them as neighbors.
+    with profiler.stage('neighbor search'):
+        edges = graph_utils.neighbor_edges(xy, neighbor_distance, tracks[current_frame]['type'], neighbor_radii)  #src, dst, dist (sparse, no self-loops)
 
     #Retrieve all past and future trajectories
     '''
@@ -189,53 +157,112 @@ def process_tracks(tracks, start_frame, end_frame, current_frame):
     '''
 
     ############ SECOND OPTION ###############3
-    now_all_object_id = set([val for frame in range(start_frame, end_frame) for val in tracks[frame]["node_id"]])  #todos los obj en los15 hist frames
-    non_visible_object_id_list = list(now_all_object_id - set(visible_node_id_list))  #obj en alguno de los 15 frames pero no el ultimo
-    total_num = len(now_all_object_id)
-
-    object_feature_list = []
-    for frame_ind in range(start_frame, end_frame):	
-        now_frame_feature_dict = {node_id : (
-            list(tracks[frame_ind]['position'][np.where(np.array(tracks[frame_ind]['node_id'])==node_id)[0][0]] - mean_xy)+ 
-            list(tracks[frame_ind]['motion'][np.where(np.array(tracks[frame_ind]['node_id'])==node_id)[0][0]]) + 
-            list(tracks[frame_ind]['info_agent'][np.where(np.array(tracks[frame_ind]['node_id'])==node_id)[0][0]]) +
-            list(tracks[frame_ind]['info_sequence'][0]) + [1] + [num_visible_object]
-            ) for node_id in tracks[frame_ind]["node_id"] if node_id in visible_node_id_list}
-        # if the current object is not at this frame, we return all 0s 
-        now_frame_feature = np.array([now_frame_feature_dict.get(vis_id, np.zeros(total_feature_dimension)) for vis_id in visible_node_id_list])
-        object_feature_list.append(now_frame_feature)
-
-    object_feature_list = np.array(object_feature_list)  # T,V,C
+    # rows of the visible agents in every frame of the window, gathered at once
+    rows = row_index[start_frame:end_frame][:, tracks[current_frame]['instance']]  # T,V
+    object_feature_list = np.zeros((end_frame-start_frame, num_visible_object, total_feature_dimension))  # T,V,C (0s if the object is not at that frame)
+    present = rows >= 0
+    object_feature_list[present, :row_feature.shape[1]] = row_feature[rows[present]]
+    object_feature_list[present, :3] -= mean_xy
+    object_feature_list[present, -2:] = [1, num_visible_object]
     assert object_feature_list.shape[1] < max_num_objects
     object_frame_feature = np.zeros((max_num_objects, end_frame-start_frame, total_feature_dimension))  # V, T, C
     object_frame_feature[:num_visible_object] = np.transpose(object_feature_list, (1,0,2))
     inst_sample_tokens = np.column_stack((tracks[current_frame]['node_id'], tracks[current_frame]['sample_token']))
     #visible_object_indexes = [list(now_all_object_id).index(i) for i in visible_node_id_list]
-    return object_frame_feature, neighbor_matrix, mean_xy, inst_sample_tokens
+    return object_frame_feature, edges, mean_xy, inst_sample_tokens
 
 
-def process_scene(scene):
+def angle_diff(x, y, period=2*np.pi):
+    # devkit angle_diff for arrays, difference in [-pi, pi)
+    diff = (x - y + period / 2) % period - period / 2
+    return np.where(diff > np.pi, diff - 2*np.pi, diff)
+
+
+def scene_kinematics(sample_tokens, max_time_diff=1.5):
+    '''
+    Velocity, acceleration and heading change rate of every annotation of the scene at once: finite differences with the 
+    previous annotation of the instance, nan if there is none or it is older than max_time_diff, as in PredictHelper.
+    Deviation from the devkit: velocity and acceleration are (x, y) vectors (vel_x/vel_y/acc_x/acc_y features), while
+    get_velocity_for_agent returns the speed |velocity| and get_acceleration_for_agent the difference of speeds / time.
+    heading_change_rate is the devkit value. See tests/test_nuscenes_kinematics.py.
+    :return: dict annotation token -> (velocity (2,), acceleration (2,), heading_change_rate)
     '''
+    nuscenes = get_nuscenes()
+    tokens, prev_tokens, translation, rotation, timestamp = [], [], [], [], []
+    for sample_token in sample_tokens:
+        sample = nuscenes.get('sample', sample_token)
+        for token in sample['anns']:
+            annotation = nuscenes.get('sample_annotation', token)
+            tokens.append(token)
+            prev_tokens.append(annotation['prev'])
+            translation.append(annotation['translation'][:2])
+            rotation.append(annotation['rotation'])
+            timestamp.append(sample['timestamp'])
+    index = {token: i for i, token in enumerate(tokens)}
+    prev = np.array([index.get(token, -1) for token in prev_tokens], dtype=int)
+    xy = np.array(translation, dtype=float).reshape(-1, 2)
+    w, x, y, z = np.array(rotation, dtype=float).reshape(-1, 4).T
+    yaw = np.arctan2(2*(x*y + w*z), 1 - 2*(y**2 + z**2))  #devkit quaternion_yaw
+    time = 1e-6 * np.array(timestamp, dtype=float)
+
+    time_diff = time - time[prev]
+    valid = (prev >= 0) & (time_diff <= max_time_diff)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocity = np.where(valid[:, None], (xy - xy[prev]) / time_diff[:, None], np.nan)
+        acceleration = np.where(valid[:, None], (velocity - velocity[prev]) / time_diff[:, None], np.nan)
+        heading_change_rate = np.where(valid, angle_diff(yaw, yaw[prev]) / time_diff, np.nan)
+    return {token: (velocity[i], acceleration[i], heading_change_rate[i]) for i, token in enumerate(tokens)}
+
+
+def resize_maps(images):
+    # [N,500,500,3] uint8 -> [N,112,112,3] uint8
+    return np.array( transform(torch.tensor(np.asarray(images).transpose(0,3,1,2))) ).transpose(0,2,3,1)
+
+
+def static_map(instance, sample_token, static_maps, map_encoding):
+    '''
+    Static layers of the agent image at 500x500 and encoded at 112x112, memoized in static_maps on the pose of the agent:
+    parked or stopped agents have the same pose in many samples and their static layers are rendered once.
+    '''
+    helper = get_helper()
+    annotation = helper.get_sample_annotation(instance, sample_token)
+    key = (helper.get_map_name_from_sample_token(sample_token), tuple(annotation['translation'][:2]), tuple(annotation['rotation']))
+    if key not in static_maps:
+        static = get_input_representation().static_layer_rasterizer.make_representation(instance, sample_token)
+        static_maps[key] = static, map_rasterizer.encode_images(resize_maps(static[None]), map_encoding)[0]
+    return static_maps[key]
+
+
+def process_scene(scene, map_encoding='rgb'):
+    '''
+    map_encoding: how the HD map of each agent is stored, see map_rasterizer.MAP_ENCODINGS
     Returns a list of (n_frames ~40f = 20s) tracks_per_frame ordered by frame.
     Each row contains a dict, where each key corresponds to an array of data from all agents in that frame.
     '''
+    nuscenes, helper, input_representation = get_nuscenes(), get_helper(), get_input_representation()
     scene_id = int(scene['name'].replace('scene-', ''))   #419 la que data empieza en frame 4 data.frame_id.unique() token '8c84164e752a4ab69d039a07c898f7af'
-    data = pd.DataFrame(columns=['scene_id',
-                                 'sample_token',
-                                 'frame_id',
-                                 'type',
-                                 'node_id',
-                                 'x_global',
-                                 'y_global', 
-                                 'heading',
-                                 'vel_x',
-                                 'vel_y',
-                                 'acc_x',
-                                 'acc_y',
-                                 'heading_change_rate',
-                                 'length',
-                                 'width',
-                                 'height'])
+    columns = ['scene_id',
+               'sample_token',
+               'frame_id',
+               'type',
+               'node_id',
+               'x_global',
+               'y_global', 
+               'heading',
+               'vel_x',
+               'vel_y',
+               'acc_x',
+               'acc_y',
+               'heading_change_rate',
+               'length',
+               'width',
+               'height']
+    data = {column: [] for column in columns}  #filled per annotation, the DataFrame is built once per scene
+    sample_tokens = [scene['first_sample_token']]
+    while nuscenes.get('sample', sample_tokens[-1])['next']:
+        sample_tokens.append(nuscenes.get('sample', sample_tokens[-1])['next'])
+    with profiler.stage('kinematics'):
+        kinematics = scene_kinematics(sample_tokens)
     sample_token = scene['first_sample_token']
     sample = nuscenes.get('sample', sample_token)
     frame_id = 0
@@ -272,29 +299,27 @@ def process_scene(scene):
                 continue
 
             #if first sample returns nan
-            heading_change_rate = helper.get_heading_change_rate_for_agent(instance_token, sample_token)
-            velocity =  helper.get_velocity_for_agent(instance_token, sample_token)
-            acceleration = helper.get_acceleration_for_agent(instance_token, sample_token)
-            
-
-            data_point = pd.Series({'scene_id': scene_id,
-                                    'sample_token': sample_token,
-                                    'frame_id': frame_id,
-                                    'type': node_type,
-                                    'node_id': instance_token,
-                                    'x_global': annotation['translation'][0],
-                                    'y_global': annotation['translation'][1],
-                                    'heading': Quaternion(annotation['rotation']).yaw_pitch_roll[0],
-                                    'vel_x': velocity[0],
-                                    'vel_y': velocity[1],
-                                    'acc_x': acceleration[0],
-                                    'acc_y': acceleration[1],
-                                    'heading_change_rate': heading_change_rate,
-                                    'length': annotation['size'][0],
-                                    'width': annotation['size'][1],
-                                    'height': annotation['size'][2]}).fillna(0)    #inplace=True         
-
-            data = data.append(data_point, ignore_index=True)
+            velocity, acceleration, heading_change_rate = kinematics[annotation['token']]
+
+            data_point = {'scene_id': scene_id,
+                          'sample_token': sample_token,
+                          'frame_id': frame_id,
+                          'type': node_type,
+                          'node_id': instance_token,
+                          'x_global': annotation['translation'][0],
+                          'y_global': annotation['translation'][1],
+                          'heading': Quaternion(annotation['rotation']).yaw_pitch_roll[0],
+                          'vel_x': velocity[0],
+                          'vel_y': velocity[1],
+                          'acc_x': acceleration[0],
+                          'acc_y': acceleration[1],
+                          'heading_change_rate': heading_change_rate,
+                          'length': annotation['size'][0],
+                          'width': annotation['size'][1],
+                          'height': annotation['size'][2]}
+
+            for column, value in data_point.items():
+                data[column].append(value)
 
         sample = nuscenes.get('sample', sample['next'])
         sample_token = sample['token']
@@ -307,72 +332,111 @@ def process_scene(scene):
         data[-1]['x_global'] = data['x_global'] - mean_xy[-1][0]
         data['y_global'] = data['y_global'] - mean_xy[-1][1]
         '''
-
-    #data.sort_values('frame_id', inplace=True)
-    tracks_per_frame=data.groupby(['frame_id'], sort=True)
-    '''
-    Tracks is a list of n_frames rows ordered by frame.
-    Each row contains a dict, where each key corresponds to an array of data from all agents in that frame.
-    '''
-    tracks = []
-    for frame, track_rows in tracks_per_frame:
-        #track_rows contains info of all agents in frame
-        track = track_rows.to_dict(orient="list")
+    data = pd.DataFrame(data, columns=columns).fillna(0)  #nan kinematics (first sample of an agent) -> 0
+    # (frame, instance) -> row of data, built once for all the windows of the scene. Frames are positions in tracks
+    # (frames without agents have no track) and the first row wins if an instance appears twice in a frame
+    frame_pos = data.groupby('frame_id', sort=True).ngroup().values
+    instance = pd.factorize(data['node_id'])[0]
+    row_index = np.full((frame_pos.max()+1 if len(data) else 0, instance.max()+1 if len(data) else 0), -1, dtype=np.int64)
+    _, first_rows = np.unique(frame_pos * row_index.shape[1] + instance, return_index=True)
+    row_index[frame_pos[first_rows], instance[first_rows]] = first_rows
+    row_feature = data[['x_global', 'y_global', 'heading', 'vel_x', 'vel_y', 'acc_x', 'acc_y', 'heading_change_rate',
+                        'type', 'length', 'width', 'height', 'frame_id', 'scene_id']].values.astype(float)
+
+    with profiler.stage('grouping'):
+        #data.sort_values('frame_id', inplace=True)
+        tracks_per_frame=data.groupby(['frame_id'], sort=True)
+        '''
+        Tracks is a list of n_frames rows ordered by frame.
+        Each row contains a dict, where each key corresponds to an array of data from all agents in that frame.
+        '''
+        # boxes of all the frames of the scene at once (data has a RangeIndex, track_rows.index are its positions)
+        bboxes = geometry.rotated_box_corners(data["x_global"].values, data["y_global"].values,
+                                              data["length"].values, data["width"].values, np.deg2rad(data["heading"].values.astype(float)))
+        tracks = []
+        for frame, track_rows in tracks_per_frame:
+            #track_rows contains info of all agents in frame
+            track = track_rows.to_dict(orient="list")
         
-        for key, value in track.items():
-            if key not in ["frame_id", "scene_id", "node_id", "sample_token"]:
-                track[key] = np.array(value)
+            for key, value in track.items():
+                if key not in ["frame_id", "scene_id", "node_id", "sample_token"]:
+                    track[key] = np.array(value)
             
-        track['info_sequence'] = np.stack([track["frame_id"],track["scene_id"]], axis=-1)
-        track['info_agent'] = np.stack([track["type"],track["length"],track["width"],track["height"]], axis=-1)
-        track["position"] = np.stack([track["x_global"], track["y_global"], track["heading"]], axis=-1)
-        track['motion'] = np.stack([track["vel_x"], track["vel_y"], track["acc_x"],track["acc_y"], track["heading_change_rate"]], axis=-1)
-        track["bbox"] = calculate_rotated_bboxes(track["x_global"], track["y_global"],
-                                                track["length"], track["width"],
-                                                np.deg2rad(track["heading"]))
+            track['info_sequence'] = np.stack([track["frame_id"],track["scene_id"]], axis=-1)
+            track['info_agent'] = np.stack([track["type"],track["length"],track["width"],track["height"]], axis=-1)
+            track["position"] = np.stack([track["x_global"], track["y_global"], track["heading"]], axis=-1)
+            track['motion'] = np.stack([track["vel_x"], track["vel_y"], track["acc_x"],track["acc_y"], track["heading_change_rate"]], axis=-1)
+            track["bbox"] = bboxes[track_rows.index.values]
+            track["instance"] = instance[track_rows.index.values]
     
-        tracks.append(track)
+            tracks.append(track)
 
 
     frame_id_list = list(range(len(tracks)))   #list(range(data.frame_id.unique()[0], range(data.frame_id.unique()[-1])))
     #assert len(frame_id_list) == len(tracks), f"{len(frame_id_list)} != {len(tracks)}"
     all_feature_list = []
-    all_adjacency_list = []
+    all_edges_list = []
     all_mean_list = []
     tokens_list = []
     maps_list = []
+    # rgb / gray maps: static layers deduplicated by content (map_table) + per-window overlay of the pixels that differ (agents)
+    static_maps = {}
+    map_table = {}  #sha1 of the encoded static map -> (id, map)
+    static_ids_list, overlay_pixels_list, overlay_values_list = [], [], []
     visible_object_indexes_list=[]
-    step=2 #iterate over 2s
     for start_ind in frame_id_list[:-total_frames+1:step]:
         current_frame = start_ind + history_frames -1   #0,8,16,24
         end_ind = start_ind + total_frames
-        object_frame_feature, neighbor_matrix, mean_xy, inst_sample_tokens = process_tracks(tracks, start_ind, end_ind, current_frame)  
+        with profiler.stage('windows'):
+            object_frame_feature, edges, mean_xy, inst_sample_tokens = process_tracks(tracks, start_ind, end_ind, current_frame, row_index, row_feature)  
         
         #HD MAPs
         sample_token = tracks[current_frame]['sample_token'][0]
         
         #maps = [transform(input_representation.make_input_representation(instance, sample_token)) for instance in tracks[current_frame]["node_id"]]   #Tensor [N_agents,3,112,112] float32 [0,1]       
         
-        maps = np.array( [input_representation.make_input_representation(instance, sample_token) for instance in tracks[current_frame]["node_id"]] )   #[N_agents,500,500,3] uint8 range [0,256] 
-        maps = np.array( transform(torch.tensor(maps.transpose(0,3,1,2))) ).transpose(0,2,3,1)
-
-        save_path_map = os.path.join(base_path_map, sample_token + '.pkl')
-        with open(save_path_map, 'wb') as writer:
-            pickle.dump(maps,writer)  
+        with profiler.stage('map rasterization'):
+            if map_encoding == 'masks':
+                # map layers + agent boxes (without the faded history), [N_agents,5,500,500] bool
+                masks = [np.concatenate([input_representation.static_layer_rasterizer.make_layer_masks(instance, sample_token),
+                                         input_representation.agent_rasterizer.make_representation(instance, sample_token).any(-1)[None]]) 
+                         for instance in tracks[current_frame]["node_id"]]
+                maps_list.append(map_rasterizer.pack_masks(np.array(masks).reshape(-1, 5, 500, 500)))   #[N_agents,5,112,14] uint8
+            else:
+                # same images as input_representation.make_input_representation, static layers reused
+                statics = [static_map(instance, sample_token, static_maps, map_encoding) for instance in tracks[current_frame]["node_id"]]
+                maps = np.array( [input_representation.combinator.combine([static, input_representation.agent_rasterizer.make_representation(instance, sample_token)])
+                                  for (static, _), instance in zip(statics, tracks[current_frame]["node_id"])] )   #[N_agents,500,500,3] uint8 range [0,256] 
+                maps = map_rasterizer.encode_images(resize_maps(maps), map_encoding)   #[N_agents,112,112(,3)] uint8, one per visible agent (same order)
+                static_ids, overlay_pixels, overlay_values = [], [], []
+                for agent_row, ((_, static), agent_map) in enumerate(zip(statics, maps)):
+                    digest = hashlib.sha1(static.tobytes()).digest()
+                    if digest not in map_table:
+                        map_table[digest] = len(map_table), static
+                    static_ids.append(map_table[digest][0])
+                    static_flat, agent_flat = static.reshape(112*112, -1), agent_map.reshape(112*112, -1)  #pixels, channels
+                    pixels = np.flatnonzero((static_flat != agent_flat).any(-1))
+                    overlay_pixels.append(np.stack([np.full(len(pixels), agent_row), pixels], -1))
+                    overlay_values.append(agent_flat[pixels])
+                static_ids_list.append(np.array(static_ids, dtype=np.int32))
+                overlay_pixels_list.append(np.concatenate(overlay_pixels).astype(np.uint16))  #agent row, pixel (row*112+col)
+                overlay_values_list.append(np.concatenate(overlay_values))  #value of those pixels, (K, channels) uint8
             
-'''
         all_feature_list.append(object_frame_feature)
-        all_adjacency_list.append(neighbor_matrix)	
+        all_edges_list.append(edges)
         all_mean_list.append(mean_xy)
-        tokens_list.append(inst_sample_tokens)
+        tokens_list.append(inst_sample_tokens.astype('U32'))
 
-
-    all_adjacency = np.array(all_adjacency_list)
-    all_mean = np.array(all_mean_list)                            
-    all_feature = np.array(all_feature_list)
-    tokens = np.array(tokens_list, dtype=object)
-    return all_feature, all_adjacency, all_mean, tokens
-'''    
+    if map_encoding == 'masks':
+        map_fields, map_ragged = {}, {'maps': maps_list}  #HD map of each visible object, (N_agents,5,112,14) uint8 per sequence
+    else:
+        shape = (112, 112) if map_encoding == 'gray' else (112, 112, 3)
+        profiler.count('static maps', len(map_table))
+        profiler.count('agent maps', sum(len(ids) for ids in static_ids_list))
+        map_fields = {'map_table': np.array([m for _, m in map_table.values()], dtype=np.uint8).reshape((-1,) + shape)}
+        map_ragged = {'map_static': static_ids_list,  #id in map_table of the static layers of each visible object
+                      'overlay_pixels': overlay_pixels_list, 'overlay_values': overlay_values_list}
+    return all_feature_list, all_edges_list, all_mean_list, tokens_list, map_fields, map_ragged
 
 
 # Data splits for the CHALLENGE - returns instance and sample token  
@@ -426,37 +490,111 @@ ns_scene_names['train'] =  splits['train']
 ns_scene_names['val'] =  splits['val']
 ns_scene_names['test'] = splits['test']
 
-for data_class in ['val']:
-    all_data=[]
-    all_adjacency=[]
-    all_mean_xy=[]
-    all_tokens=[]
+def save_scene(entry_path, all_feature_sc, all_edges_sc, all_mean_sc, tokens_sc, map_fields, map_ragged):
+    if not len(all_feature_sc):
+        all_feature_sc = np.zeros((0, max_num_objects, total_frames, total_feature_dimension))
+        all_mean_sc = np.zeros((0, 3))
+    edge_src, edge_dst, edge_dist = zip(*all_edges_sc) if len(all_edges_sc) else ([], [], [])
+    # tokens are stored as int32 ids into token_table (strings of this scene, shifted when the scenes are concatenated)
+    token_values, token_offsets = data_store.pack_ragged(tokens_sc, dtype='U32')
+    token_table, token_ids = data_store.intern(token_values.reshape(-1, 2))
+    token_ids = np.split(token_ids, token_offsets[1:-1]) if len(tokens_sc) else []
+    data_store.save_store(entry_path,
+                          {'feature': np.array(all_feature_sc, dtype=np.float32),   #(N,V,T,C)
+                           'mean_xy': np.array(all_mean_sc),
+                           'token_table': token_table, **map_fields},
+                          ragged={'tokens': token_ids,  #instance, sample token id of each visible object
+                                  'edge_src': edge_src, 'edge_dst': edge_dst, 'edge_dist': edge_dist,
+                                  **map_ragged})  #HD maps, see process_scene and map_rasterizer.MAP_ENCODINGS
+
+
+def process_scene_entry(scene_token, entry_path, map_encoding='rgb'):
+    '''
+    Processes one scene into its cache entry. Runs in the pool workers, returns the scene name, 
+    number of sequences and profiler stats (merged by the main process).
+    '''
+    profiler.reset()
+    scene_start = time.perf_counter()
+    ns_scene = get_nuscenes().get('scene', scene_token)
+    with profiler.stage('annotations'):  #devkit queries, the nested stages are not included
+        all_feature_sc, all_edges_sc, all_mean_sc, tokens_sc, map_fields, map_ragged = process_scene(ns_scene, map_encoding)
+    with profiler.stage('serialization'):
+        save_scene(entry_path, all_feature_sc, all_edges_sc, all_mean_sc, tokens_sc, map_fields, map_ragged)
+    profiler.count('scenes')
+    profiler.count('windows', len(all_feature_sc))
+    profiler.count('MB cache written', profiling.dir_size_mb(entry_path))
+    print(f"Scene {ns_scene['name']} processed! {len(all_feature_sc)} sequences of 8 seconds in {time.perf_counter()-scene_start:.1f}s.")
+    return ns_scene['name'], len(all_feature_sc), profiler.stats()
+
+
+# Per-scene cache: entries are keyed on the scene token, the dataset version and the processing parameters,
+# so only new scenes / changed parameters are processed again (HD maps included, they are a field of the entry) and a crashed run resumes.
+cache_dir = os.path.join(base_path, 'cache')
+cache_params = {'version': VERSION, 'history_frames': history_frames, 'future_frames': future_frames, 'step': step,
+                'max_num_objects': max_num_objects, 'neighbor_distance': neighbor_distance,
+                'neighbor_radii': sorted(neighbor_radii.items()), 'cache_version': cache_version}
+# devkit tables and map expansion files the scenes are built from: their digests are part of the cache key
+# (computed once per run in main, not per scene), so updated annotations or maps are processed again
+INPUT_TABLES = ['scene', 'sample', 'sample_annotation', 'instance', 'category', 'attribute', 'log']
+
+
+def input_files(dataroot=DATAROOT, version=VERSION):
+    tables = [os.path.join(dataroot, version, table + '.json') for table in INPUT_TABLES]
+    return tables + sorted(glob.glob(os.path.join(dataroot, 'maps', 'expansion', '*.json')))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split', type=str, default='val', choices=['train', 'val', 'test'])
+    parser.add_argument('--workers', type=int, default=1, help='Number of scenes processed in parallel')
+    parser.add_argument('--map_encoding', type=str, default='rgb', choices=map_rasterizer.MAP_ENCODINGS, help='How the HD maps are stored')
+    parser.add_argument('--profile', type=str, default=None, help='Dump a cProfile of the run (main process) to this file')
+    args = parser.parse_args()
+
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    nuscenes = get_nuscenes()
+    get_input_representation()  #loaded before the pool forks
+    cache_params['map_encoding'] = args.map_encoding
+    cache_params['inputs'] = {os.path.relpath(path, DATAROOT): data_store.file_digest(path) for path in input_files()}
+    data_class = args.split
+    start = time.perf_counter()
+    save_path = os.path.join(base_path, 'nuscenes_step2_seq_' + data_class)  #store dir, see data_store.py
+    entry_paths = []
+    jobs = []
     for ns_scene_name in ns_scene_names[data_class]:
         scene_token = nuscenes.field2token('scene', 'name', ns_scene_name)
         ns_scene = nuscenes.get('scene', scene_token[0])
         scene_id = int(ns_scene['name'].replace('scene-', ''))
         if scene_id in scene_blacklist:  # Some scenes have bad localization
             continue
-        process_scene(ns_scene)
-        print(f"Scene {ns_scene_name} processed! ")
-'''
-        all_feature_sc, all_adjacency_sc, all_mean_sc, tokens_sc = process_scene(ns_scene)
-        print(f"Scene {ns_scene_name} processed! {all_adjacency_sc.shape[0]} sequences of 8 seconds.")
-        all_data.extend(all_feature_sc)
-        all_adjacency.extend(all_adjacency_sc)
-        all_mean_xy.extend(all_mean_sc)
-        all_tokens.extend(tokens_sc)
-
-all_data = np.array(all_data)  
-all_adjacency = np.array(all_adjacency) 
-all_mean_xy = np.array(all_mean_xy) 
-all_tokens = np.array(all_tokens)
-save_path = '/media/14TBDISK/sandra/nuscenes_processed/nuscenes_challenge_global_step2_seq_trainandval_filter.pkl' #+ data_class + '.pkl'
-with open(save_path, 'wb') as writer:
-    pickle.dump([all_data, all_adjacency, all_mean_xy, all_tokens], writer)
-print(f'Processed {all_data.shape[0]} sequences and {len(scenes_token_set)} scenes.')
-  
-'''
+        [entry_path], [todo] = data_store.cached_entries(cache_dir, [data_store.cache_key(cache_params, tokens=[ns_scene['token']])])
+        entry_paths.append(entry_path)
+        if todo:
+            jobs.append((ns_scene['token'], entry_path, args.map_encoding))
+    print(f'{len(jobs)} of {len(entry_paths)} scenes to process, the rest are cached in {cache_dir}')
+
+    # finished scenes are complete cache entries (cached_entries), a crashed run resumes from the missing ones
+    total = profiling.StageProfiler()
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+            results = [pool.apply_async(process_scene_entry, job) for job in jobs]
+            for result in results:
+                total.merge(result.get()[2])
+    else:
+        for job in jobs:
+            total.merge(process_scene_entry(*job)[2])
+
+    with total.stage('serialization'):
+        data_store.concat_stores(entry_paths, save_path, meta=cache_params, id_fields={'tokens': 'token_table', 'map_static': 'map_table'})
+    total.count('MB store written', profiling.dir_size_mb(save_path))  #cache entries are counted apart
+    print(f"Processed {len(data_store.load_store(save_path)['feature'])} sequences.")
+    total.report(time.perf_counter() - start)
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
 
 #To return the past/future data for the entire sample (local/global - in_agent_frame=T/F)
 #sample_ann = helper.get_annotations_for_sample(sample_token)
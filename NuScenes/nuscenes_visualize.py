@@ -7,7 +7,8 @@ import sys
 sys.path.append('../../DBU_Graph')
 os.environ['DGLBACKEND'] = 'pytorch'
 import numpy as np
-from nuscenes_Dataset import nuscenes_Dataset
+from nuscenes_Dataset import nuscenes_Dataset, decode_maps
+import devkit
 from models.VAE_GNN import VAE_GNN
 from models.scout import SCOUT
 #from VAE_GATED import VAE_GATED
@@ -18,7 +19,6 @@ from utils import str2bool, compute_change_pos
 from nuscenes.eval.prediction.data_classes import Prediction
 import json
 from torchvision import transforms, utils
-from nuscenes import NuScenes
 from nuscenes.map_expansion.map_api import NuScenesMap
 import math
 import seaborn as sns
@@ -26,7 +26,6 @@ from PIL import Image
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 import matplotlib.patheffects as pe
-from nuscenes.prediction import PredictHelper
 from pyquaternion import Quaternion
 from nuscenes.eval.common.utils import quaternion_yaw, angle_diff
 
@@ -43,9 +42,7 @@ input_dim_model = (history_frames-1)*9 #Input features to the model: x,y-global
 output_dim = future_frames*2
 base_path='/media/14TBDISK/sandra/nuscenes_processed'
 DATAROOT = '/media/14TBDISK/nuscenes'
-nuscenes = NuScenes('v1.0-trainval', dataroot=DATAROOT)   #850 scenes
-
-helper = PredictHelper(nuscenes)
+# NuScenes and PredictHelper are loaded on first use (devkit.get_nuscenes / get_helper), importing this module stays cheap
 
 layers = ['drivable_area',
           'road_segment',
@@ -79,7 +76,7 @@ def collate_batch(samples):
     feats = torch.vstack(feats)
     gt = torch.vstack(gt).float()
     if maps[0] is not None:
-        maps = torch.vstack(maps)
+        maps = decode_maps(torch.vstack(maps))
     sizes_n = [graph.number_of_nodes() for graph in graphs] # graph sizes
     snorm_n = [torch.FloatTensor(size, 1).fill_(1 / size) for size in sizes_n]
     snorm_n = torch.cat(snorm_n).sqrt()  # graph size normalization 
@@ -126,6 +123,7 @@ class LitGNN(pl.LightningModule):
          
     def test_step(self, test_batch, batch_idx):
         batched_graph, output_masks,snorm_n, snorm_e, feats, labels_pos, tokens_eval, scene_id, mean_xy, maps = test_batch
+        tokens_eval = self.test_dataset.token_strings(tokens_eval)  #ids -> instance, sample token strings for the devkit
         if scene_id != self.scene_id:
             return 
         
@@ -166,6 +164,8 @@ class LitGNN(pl.LightningModule):
         prediction_all_agents = np.array(prediction_all_agents)        
         
         #VISUALIZE SEQUENCE
+        nuscenes = devkit.get_nuscenes('v1.0-trainval', DATAROOT)   #850 scenes, full devkit (sample_data, ego_pose)
+        helper = devkit.get_helper()
         #Get Scene from sample token ie current frame
         sample_token = tokens_eval[0][1]
         scene=nuscenes.get('scene', nuscenes.get('sample',sample_token)['scene_token'])
@@ -332,15 +332,15 @@ def main(args: Namespace):
     test_dataset = nuscenes_Dataset(train_val_test='test', rel_types=args.ew_dims>1, history_frames=history_frames, future_frames=future_frames, challenge_eval=True)  #25 seq 2 scenes 103, 916
 
     if args.model_type == 'vae_gated':
-        model = VAE_GATED(input_dim_model, args.hidden_dims, z_dim=args.z_dims, output_dim=output_dim, fc=False, dropout=args.dropout,  ew_dims=args.ew_dims)
+        model = VAE_GATED(input_dim_model, args.hidden_dims, z_dim=args.z_dims, output_dim=output_dim, fc=False, dropout=args.dropout,  ew_dims=args.ew_dims, map_channels=test_dataset.map_channels)
     elif  args.model_type == 'vae_gat':
         model = VAE_GNN(input_dim_model, args.hidden_dims//args.heads, args.z_dims, output_dim, fc=False, dropout=args.dropout, 
                         feat_drop=args.feat_drop, attn_drop=args.attn_drop, heads=args.heads, att_ew=args.att_ew, 
-                        ew_dims=args.ew_dims, backbone=args.backbone)
+                        ew_dims=args.ew_dims, backbone=args.backbone, map_channels=test_dataset.map_channels)
     elif args.model_type == 'scout':
         hidden_dims = round(args.hidden_dims // args.heads)
         model = SCOUT(input_dim=input_dim_model, hidden_dim=hidden_dims, output_dim=output_dim, heads=args.heads, dropout=args.dropout, 
-                        feat_drop=args.feat_drop, attn_drop=args.attn_drop, att_ew=args.att_ew, ew_type=args.ew_dims>1, backbone=args.backbone)
+                        feat_drop=args.feat_drop, attn_drop=args.attn_drop, att_ew=args.att_ew, ew_type=args.ew_dims>1, backbone=args.backbone, map_channels=test_dataset.map_channels)
     
 
     LitGNN_sys = LitGNN(model=model,  model_type = args.model_type,history_frames=history_frames, future_frames= future_frames, train_dataset=None, val_dataset=None,
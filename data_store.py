@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+'''
+Columnar on-disk format for the processed sequences.
+
+A store is a directory with one .npy file per field plus an index.json that lists the fields.
+Fields are opened with np.load(mmap_mode='r'), so opening a store costs nothing and the pages are
+shared by every process (DataLoader workers) that reads it.
+Ragged per-sequence fields (e.g. visible object indexes) are stored flat with a <field>_offsets.npy,
+sequence i being values[offsets[i]:offsets[i+1]].
+The index also keeps a digest of the data (see store_digest), so caches derived from a store (e.g. graph_cache)
+are invalidated when it is rebuilt with different contents.
+'''
+
+INDEX_FILE = 'index.json'
+
+
+def pack_ragged(seqs, dtype=None):
+    '''
+    List of sequences (arrays with the same trailing shape) -> (flat values, offsets) with len(offsets) = len(seqs)+1
+    '''
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate([np.asarray(s, dtype=dtype) for s in seqs]) if len(seqs) else np.zeros(0, dtype=dtype)
+    return values, offsets
+
+
+def intern(strings):
+    '''
+    Strings (any shape) -> (table, ids): table of the unique strings and int32 ids with the shape of strings,
+    table[ids] == strings. Ids can be stored in place of the strings (fixed size, no object arrays).
+    '''
+    table, ids = np.unique(np.asarray(strings), return_inverse=True)
+    return table, ids.reshape(np.shape(strings)).astype(np.int32)
+
+
+def save_store(path, fields, ragged=None, meta=None):
+    '''
+    :fields: dict name -> array, all with the number of sequences as first dimension (except string tables, see intern)
+    :ragged: dict name -> list of arrays (one per sequence), stored flat + offsets
+    :meta:   json-serializable dict saved in the index (preprocessing parameters...)
+    The digest of the written files is saved in the index too. The store is written in a temporary directory and renamed at the end, so a crash never leaves
+    a half-written store behind.
+    '''
+    ragged = ragged or {}
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, value in fields.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(value))
+    for name, seqs in ragged.items():
+        values, offsets = pack_ragged(seqs)
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+        np.save(os.path.join(tmp_path, name + '_offsets.npy'), offsets)
+    index = {'fields': list(fields), 'ragged': list(ragged), 'meta': meta or {}}
+    index['digest'] = files_digest(tmp_path, index)
+    with open(os.path.join(tmp_path, INDEX_FILE), 'w') as writer:
+        json.dump(index, writer)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class Ragged:
+    '''
+    Read-only view of a ragged field: ragged[i] returns the values of sequence i.
+    '''
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+
+def load_store(path, mmap_mode='r'):
+    '''
+    Returns a dict name -> memory-mapped array (or Ragged view), plus 'meta'.
+    '''
+    with open(os.path.join(path, INDEX_FILE)) as reader:
+        index = json.load(reader)
+    store = {'meta': index['meta']}
+    for name in index['fields']:
+        store[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    for name in index['ragged']:
+        store[name] = Ragged(np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode),
+                             np.load(os.path.join(path, name + '_offsets.npy'), mmap_mode=mmap_mode))
+    return store
+
+
+_shared = {}
+
+
+def shared_store(path):
+    '''
+    load_store(path) opened once per process: the train/val/test datasets of a store share its arrays
+    and only keep their own sequence indexes.
+    Reopened if the store was rewritten.
+    '''
+    key = os.path.abspath(path)
+    mtime = os.path.getmtime(os.path.join(path, INDEX_FILE))
+    if key not in _shared or _shared[key][0] != mtime:
+        _shared[key] = (mtime, load_store(path))
+    return _shared[key][1]
+
+
+def concat_stores(paths, out_path, meta=None, id_fields=None):
+    '''
+    Concatenate stores with the same fields (e.g. one per recording) in the given order.
+    Fields are copied shard by shard into preallocated .npy files, so memory stays bounded.
+    :id_fields: dict field -> table field, for ids made with intern: the table fields are concatenated and the ids
+                of each shard shifted by the length of the tables of the previous shards
+    '''
+    id_fields = id_fields or {}
+    shards = [load_store(p) for p in paths]
+    # shift of the ids of each shard
+    id_shift = {name: np.cumsum([0] + [len(s[table]) for s in shards[:-1]]) for name, table in id_fields.items() if table in shards[0]}
+    with open(os.path.join(paths[0], INDEX_FILE)) as reader:
+        index = json.load(reader)
+    tmp_path = out_path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in index['fields']:
+        first = shards[0][name]
+        total = sum(len(s[name]) for s in shards)
+        out = np.lib.format.open_memmap(os.path.join(tmp_path, name + '.npy'), mode='w+',
+                                        dtype=first.dtype, shape=(total,) + first.shape[1:])
+        start = 0
+        for i, s in enumerate(shards):
+            out[start:start+len(s[name])] = s[name] + id_shift[name][i] if name in id_shift else s[name]
+            start += len(s[name])
+        out.flush()
+        del out
+    for name in index['ragged']:
+        # skip empty shards, their values have no dtype/shape information
+        nonempty = [(i, s[name].values) for i, s in enumerate(shards) if len(s[name].values)] or [(0, shards[0][name].values)]
+        first = nonempty[0][1]
+        out = np.lib.format.open_memmap(os.path.join(tmp_path, name + '.npy'), mode='w+', dtype=first.dtype,
+                                        shape=(sum(len(v) for _, v in nonempty),) + first.shape[1:])
+        start = 0
+        for i, values in nonempty:  #copied shard by shard too, ragged fields can be large (e.g. HD maps)
+            out[start:start+len(values)] = values + id_shift[name][i] if name in id_shift else values
+            start += len(values)
+        out.flush()
+        del out
+        lengths = np.concatenate([np.diff(s[name].offsets) for s in shards])
+        offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(tmp_path, name + '_offsets.npy'), offsets)
+    index['meta'] = meta if meta is not None else index['meta']
+    # the output only depends on the shards (in order) and the id shifts, no need to read it back
+    h = hashlib.sha1(json.dumps(sorted(id_shift)).encode())
+    for p in paths:
+        h.update(store_digest(p).encode())
+    index['digest'] = h.hexdigest()
+    with open(os.path.join(tmp_path, INDEX_FILE), 'w') as writer:
+        json.dump(index, writer)
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.rename(tmp_path, out_path)
+
+
+def file_digest(path, chunk_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def files_digest(path, index):
+    # digest of the .npy files of the store at path, in index order
+    h = hashlib.sha1()
+    for name in index['fields'] + [n + suffix for n in index['ragged'] for suffix in ('', '_offsets')]:
+        h.update(file_digest(os.path.join(path, name + '.npy')).encode())
+    return h.hexdigest()
+
+
+def store_digest(path):
+    '''
+    Digest of the data of a store: the one saved in its index, or computed from its files for stores written before.
+    Changes whenever the store is rebuilt with different contents, unlike its parameters or field list.
+    '''
+    with open(os.path.join(path, INDEX_FILE)) as reader:
+        index = json.load(reader)
+    return index.get('digest') or files_digest(path, index)
+
+
+def cache_key(params, files=(), tokens=()):
+    '''
+    Content address of a preprocessing output: hash of the parameters (json-serializable dict),
+    the contents of the input files and any extra identifiers (e.g. a nuScenes scene token).
+    '''
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for f in files:
+        h.update(file_digest(f).encode())
+    for t in tokens:
+        h.update(str(t).encode())
+    return h.hexdigest()
+
+
+def cached_entries(cache_dir, keys):
+    '''
+    Cache entries are stores named by their key inside cache_dir. Since save_store only renames the
+    store into place once it is complete, an entry that exists is valid and a crashed run resumes
+    by recomputing only the missing ones.
+    :return: entry paths (same order as keys) and a list of booleans, True if the entry must be computed
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = [os.path.join(cache_dir, key) for key in keys]
+    return paths, [not is_store(path) for path in paths]
+
+
+def convert_pickle(pkl_path, out_path, history_frames=8):
+    '''
+    Convert an old inD/rounD pickle [all_feature (N,C,T,V), all_adjacency, all_mean_xy, all_visible_object_indexes]
+    to a store. Dense adjacency matrices become edge lists, with distances taken at the last history frame.
+    '''
+    with open(pkl_path, 'rb') as reader:
+        [all_feature, all_adjacency, all_mean_xy, all_visible_object_indexes] = pickle.load(reader)
+    all_feature = np.transpose(all_feature, (0,3,2,1)).astype(np.float32)  #(N,V,T,C)
+    edge_src, edge_dst, edge_dist = [], [], []
+    for adjacency, feature, visible_object_idx in zip(all_adjacency, all_feature, all_visible_object_indexes):
+        num_visible_object = len(visible_object_idx)
+        src, dst = np.nonzero(adjacency[:num_visible_object,:num_visible_object] * (1-np.eye(num_visible_object)))
+        xy = feature[np.asarray(visible_object_idx, dtype=int), history_frames-1, :2]
+        edge_src.append(src.astype(np.int32))
+        edge_dst.append(dst.astype(np.int32))
+        edge_dist.append(np.linalg.norm(xy[src]-xy[dst], axis=-1).astype(np.float32))
+    save_store(out_path,
+               {'feature': all_feature,
+                'mean_xy': np.asarray(all_mean_xy, dtype=float),
+                'recording_id': all_feature[:,:,:,5].max(axis=(1,2)).astype(np.int32)},  # absent objects are 0s
+               ragged={'visible_object_idx': [np.asarray(v, dtype=np.int64) for v in all_visible_object_indexes],
+                       'edge_src': edge_src, 'edge_dst': edge_dst, 'edge_dist': edge_dist})
+
+
+if __name__ == '__main__':
+    # python data_store.py old.pkl new_store_dir [history_frames]
+    convert_pickle(sys.argv[1], sys.argv[2], *[int(arg) for arg in sys.argv[3:]])
@@ -0,0 +1,33 @@
+import numpy as np
+try:
+    import torch
+except ImportError:  #the preprocessing of inD/rounD does not need torch
+    torch = None
+
+# corners of a box of length 1 and width 1 centred in 0, main axis (length) along x
+UNIT_BOX_CORNERS = np.array([[-0.5, -0.5],
+                             [ 0.5, -0.5],
+                             [ 0.5,  0.5],
+                             [-0.5,  0.5]])
+
+
+def rotated_box_corners(center_x, center_y, length, width, rotation=0):
+    '''
+    Corners of rotated bounding boxes, in one batched rotation for any leading shape (agents, frames...).
+    Inputs are numpy arrays or torch tensors that broadcast together (rotation in radians, along the length axis).
+    :return: (..., 4, 2) corners, same type as center_x
+    '''
+    if torch is not None and isinstance(center_x, torch.Tensor):
+        xp = torch
+        unit = torch.as_tensor(UNIT_BOX_CORNERS, dtype=center_x.dtype, device=center_x.device)
+    else:
+        xp = np
+        center_x, center_y, length, width, rotation = [np.asarray(v, dtype=float) for v in (center_x, center_y, length, width, rotation)]
+        unit = UNIT_BOX_CORNERS
+    rotation = rotation + 0*center_x  #broadcast a scalar rotation
+    cos, sin = xp.cos(rotation)[..., None], xp.sin(rotation)[..., None]
+    corner_x = unit[:, 0] * length[..., None]
+    corner_y = unit[:, 1] * width[..., None]
+    return xp.stack([center_x[..., None] + cos*corner_x - sin*corner_y,
+                     center_y[..., None] + sin*corner_x + cos*corner_y], -1)
+
@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+import dgl
+import data_store
+
+'''
+Graphs of a dataset built once and stored as edge arrays (data_store format), so __getitem__ only slices them.
+A cache holds, for every item of the dataset (split), the number of nodes, the edges (self-loops included, in the
+order of the graph) and every edge data field (edata_<name>). Caches live in <raw_dir>_graphs/<key>, the key being
+the hash of the parameters that change the graphs and of the data of the store (data_store.store_digest), so they are
+rebuilt when either changes.
+'''
+
+
+def save_graphs(path, graphs, meta=None):
+    edata = list(graphs[0].edata.keys()) if len(graphs) else []
+    data_store.save_store(path,
+                          {'num_nodes': np.array([graph.num_nodes() for graph in graphs], dtype=np.int64)},
+                          ragged={'src': [graph.edges()[0].numpy() for graph in graphs],
+                                  'dst': [graph.edges()[1].numpy() for graph in graphs],
+                                  **{'edata_' + name: [graph.edata[name].numpy() for graph in graphs] for name in edata}},
+                          meta={'edata': edata, **(meta or {})})
+
+
+class GraphCache:
+    '''
+    cache[idx] returns the DGL graph of item idx with its edge data.
+    '''
+    def __init__(self, path):
+        self.store = data_store.load_store(path)
+        self.edata = self.store['meta']['edata']
+
+    def __len__(self):
+        return len(self.store['num_nodes'])
+
+    def __getitem__(self, idx):
+        graph = dgl.graph((torch.from_numpy(np.array(self.store['src'][idx])), torch.from_numpy(np.array(self.store['dst'][idx]))),
+                          num_nodes=int(self.store['num_nodes'][idx]), idtype=torch.int32)
+        for name in self.edata:
+            graph.edata[name] = torch.from_numpy(np.array(self.store['edata_' + name][idx]))
+        return graph
+
+
+def load_or_build(raw_dir, params, build_graph, num_graphs):
+    '''
+    :params: json-serializable parameters of the dataset that change its graphs (split, frames, model type...)
+    :build_graph: function idx -> graph, called for every idx in range(num_graphs) if the cache does not exist
+    '''
+    key = data_store.cache_key(params, tokens=[data_store.store_digest(raw_dir)])
+    [path], [todo] = data_store.cached_entries(raw_dir.rstrip('/') + '_graphs', [key])
+    if todo:
+        print(f'Building graph cache {path} ({num_graphs} graphs)')
+        save_graphs(path, [build_graph(idx) for idx in range(num_graphs)], meta=params)
+    return GraphCache(path)
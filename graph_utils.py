@@ -0,0 +1,87 @@
+import contextlib
+import numpy as np
+from scipy import spatial
+
+
+def neighbor_edges(xy, neighbor_distance, types=None, radii=None):
+    '''
+    Edges between every pair of objects closer than their radius, self-loops excluded.
+    Pairs are found with a KD-tree, so the cost grows with the number of edges instead of V^2.
+    :xy: (V, 2) positions of the nodes of the graph
+    :neighbor_distance: radius of the pairs of classes not in radii
+    :types: (V,) class of each node, only needed with radii
+    :radii: dict {(class_a, class_b): radius}, symmetric
+    :return: src, dst (int32) and edge distances (float32), ordered by (src, dst) like a CSR matrix
+    '''
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    max_radius = max([neighbor_distance] + list(radii.values())) if radii else neighbor_distance
+    pairs = spatial.cKDTree(xy).query_pairs(max_radius, output_type='ndarray')  #i < j
+    src = np.concatenate([pairs[:,0], pairs[:,1]])
+    dst = np.concatenate([pairs[:,1], pairs[:,0]])
+    dist = np.linalg.norm(xy[src] - xy[dst], axis=-1)
+
+    radius = np.full(len(src), neighbor_distance, dtype=float)
+    if radii:
+        types = np.asarray(types).astype(int)
+        for (a, b), r in radii.items():
+            radius[((types[src]==a) & (types[dst]==b)) | ((types[src]==b) & (types[dst]==a))] = r
+    keep = np.flatnonzero(dist < radius)
+    keep = keep[np.lexsort((dst[keep], src[keep]))]
+    return src[keep].astype(np.int32), dst[keep].astype(np.int32), dist[keep].astype(np.float32)
+
+
+def process_data(tracks, start_ind, end_ind, observed_last, num_objects, distance, profiler=None, with_edges=True):
+    #tracks es el dict de ind_tracks_import.read_tracks: row_index (frames x tracks) + tabla de features por fila
+    #num_objects: padding of the object dimension, distance: neighbor distance, profiler: times the neighbor search if given
+    #with_edges=False skips the neighbor search (edges is None), e.g. when the graphs come from graph_cache
+    rows = tracks['row_index'][start_ind:end_ind]  # (T, K), -1 if the track is not in that frame
+    now_present = rows[observed_last-start_ind] >= 0
+    visible_object_list = np.flatnonzero(now_present) # object_id appears at the last observed frame
+    #para ver los obj visibles en esa secuencia miramos el final de la sec
+    non_visible_object_list = np.flatnonzero((rows >= 0).any(axis=0) & ~now_present)  #obj en alguno de los frames pero no el ultimo
+    num_visible_object = visible_object_list.size # number of current observed objects
+    # visible objects go first, so node i of the graph is object i of the sequence
+    rows = rows[:, np.concatenate([visible_object_list, non_visible_object_list])]
+    feature_dimension = tracks['feature'].shape[1] + 1  #features of the rows + visible mark
+
+    # compute the mean values of x and y (of all obj detected) for zero-centralization. 
+    xy = tracks['feature'][rows[observed_last-start_ind, :num_visible_object], :2]   #x,y
+    mean_xy = np.zeros(feature_dimension-1, dtype=float)
+    m_xy = np.mean(xy, axis=0)
+    mean_xy[:2] = m_xy
+
+    # if their distance is less than $distance, we regard them are neighbors.
+    edges = None
+    if with_edges:
+        with profiler.stage('neighbor search') if profiler is not None else contextlib.nullcontext():
+            edges = neighbor_edges(xy, distance)  #src, dst, dist (sparse, no self-loops)
+
+    # gather the features of every (frame, object) of the sequence at once; -mean_xy is used to zero_centralize data
+    # we add mark "1" to the end of each row to indicate that the object is visible at the last observed frame
+    # if the current object is not at this frame, its row stays all 0s
+    present = rows >= 0
+    object_feature_list = np.zeros(rows.shape + (feature_dimension,))  # (T, V, C)
+    object_feature_list[present, :-1] = tracks['feature'][rows[present]] - mean_xy
+    object_feature_list[:, :num_visible_object, -1] = present[:, :num_visible_object]
+
+    # object feature with a shape of (frame#, object#, 12) -> (V, T, C)
+    object_frame_feature = np.zeros((num_objects, end_ind-start_ind, feature_dimension))
+    object_frame_feature[:rows.shape[1]] = np.transpose(object_feature_list, (1,0,2))
+    visible_object_indexes = list(range(num_visible_object))
+    return object_frame_feature, edges, m_xy, visible_object_indexes
+
+
+def window_from_rows(rows, track, frame_offsets, start_ind, history_frames, future_frames, distance, with_edges=True):
+    '''
+    Builds the sequence starting at frame start_ind from the compact per-recording table written by 
+    ind_tracks_import.process_recording_rows (rows ordered by frame, track column of each row, frame_offsets into rows).
+    Same output as process_data, without padding of the object dimension.
+    '''
+    end_ind = start_ind + history_frames + future_frames
+    r0, r1 = frame_offsets[start_ind], frame_offsets[end_ind]
+    frame_ind = np.repeat(np.arange(end_ind-start_ind), np.diff(frame_offsets[start_ind:end_ind+1]))
+    track_ids, track_ind = np.unique(track[r0:r1], return_inverse=True)
+    row_index = np.full((end_ind-start_ind, len(track_ids)), -1, dtype=np.int32)
+    row_index[frame_ind, track_ind] = np.arange(r1-r0)
+    window = {'row_index': row_index, 'feature': np.asarray(rows[r0:r1])}
+    return process_data(window, 0, end_ind-start_ind, history_frames-1, len(track_ids), distance, with_edges=with_edges)
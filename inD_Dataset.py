@@ -10,9 +10,11 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import os
 import utils
+import data_store
+import graph_utils
+import graph_cache
 os.environ['DGLBACKEND'] = 'pytorch'
 from torchvision import datasets, transforms
-import scipy.sparse as spp
 from dgl.data import DGLDataset
 from sklearn.preprocessing import StandardScaler
 
@@ -36,7 +38,7 @@ def collate_batch(samples):
 
 class inD_DGLDataset(torch.utils.data.Dataset):
 
-    def __init__(self, train_val, history_frames, future_frames, test=False, model_type='gat', data_path=None, classes=(1,2), rel_types=False):
+    def __init__(self, train_val, history_frames, future_frames, test=False, model_type='gat', data_path=None, classes=(1,2), rel_types=False, stride=None, graph_cache=False, rel_vels=False):
         
         self.train_val=train_val
         self.history_frames = history_frames
@@ -46,31 +48,51 @@ class inD_DGLDataset(torch.utils.data.Dataset):
         self.test = test
         self.classes = classes
         self.types = rel_types
+        self.stride = stride  #only for stores of recordings (ind_tracks_import.py --windows), default: step of the preprocessing
+        self.graph_cache = graph_cache  #build the graphs once (graph_cache.py) and load them in __getitem__
+        self.rel_vels = rel_vels  #also edata['rel_vel']: 1/|v_u - v_v| per edge (not used by the models)
 
-        self.raw_dir='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz8_12f_benchmark_train.pkl' #inD_2.5Hz8_12f_benchmark_train.pkl'   #inD_2.5Hz_3s5s.pkl'  #el obs_frame sigue siendo el 7 , me vale para 8/8
+        self.raw_dir='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz8_12f_benchmark_train' #store dir (see data_store.py) inD_2.5Hz8_12f_benchmark_train'   #inD_2.5Hz_3s5s'  #el obs_frame sigue siendo el 7 , me vale para 8/8
         if self.train_val == 'test':  
-            self.raw_dir ='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz8_12f_benchmark_test.pkl'   #inD_2.5Hz8_12f_benchmark_test.pkl'    #rounD_2.5Hz8_8f.pkl'     
+            self.raw_dir ='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz8_12f_benchmark_test'   #inD_2.5Hz8_12f_benchmark_test'    #rounD_2.5Hz8_8f'     
+        if data_path is not None:
+            self.raw_dir = data_path
 
         self.process()        
 
     def load_data(self):
-        with open(self.raw_dir, 'rb') as reader:
-            [all_feature, self.all_adjacency, self.all_mean_xy, self.all_visible_object_idx]= pickle.load(reader)
-        all_feature=np.transpose(all_feature, (0,3,2,1)) #(N,V,T,C)
-        self.all_feature=torch.from_numpy(all_feature[:,:,:self.total_frames,:]).type(torch.float32)
+        # memory-mapped, sequences are read in __getitem__ (store shared with the other splits)
+        store = data_store.shared_store(self.raw_dir)
+        self.windowed = store['meta'].get('windows', False)
+        if self.windowed:
+            # one entry per recording, the sequences are cut in __getitem__ for any history/future/stride
+            self.all_rows = store['feature']
+            self.all_track = store['track']
+            self.all_frame_offsets = store['frame_offsets']
+            self.neighbor_distance = store['meta']['neighbor_distance']
+            stride = self.stride or store['meta']['step']
+            self.windows = np.array([(rec, start) for rec in range(len(self.all_rows)) 
+                                     for start in range(0, len(self.all_frame_offsets[rec])-self.total_frames, stride)], dtype=int).reshape(-1,2)
+            self.recording_id = np.asarray(store['recording_id'])[self.windows[:,0]]
+            self.num_sequences = len(self.windows)
+            return
+        self.all_feature = store['feature'] #(N,V,T,C)
+        self.all_edge_src = store['edge_src']  #graph edges (sparse, no self-loops)
+        self.all_edge_dst = store['edge_dst']
+        self.all_mean_xy = store['mean_xy']
+        self.all_visible_object_idx = store['visible_object_idx']
+        self.recording_id = store['recording_id']
+        self.num_sequences = len(self.all_feature)
 
 
     def process(self):
         self.load_data()
         
-        total_num = len(self.all_feature)
+        total_num = self.num_sequences
         print(self.train_val, total_num)
         now_history_frame=self.history_frames-1
-        feature_id = [0,1,2,3,4,10]  #pos vel heading obj
-        info_feats_id = list(range(5,11))  #recording_id,frame,id, l,w, class
-        self.object_type = self.all_feature[:,:,:,-2].int()  # torch Tensor NxVxT
-        self.object_type[self.object_type==3] = 1 # truck_bus=1 (car)
-        self.object_type[self.object_type==4] = 3 # bic = 3
+        self.feature_id = [0,1,2,3,4,10]  #pos vel heading obj
+        self.info_feats_id = list(range(5,11))  #recording_id,frame,id, l,w, class
         
         '''
         mask_car=torch.zeros((total_num,self.all_feature.shape[1],self.total_frames))#.to('cuda') #NxVx10
@@ -79,26 +101,11 @@ class inD_DGLDataset(torch.utils.data.Dataset):
             mask_car[i,:]=mask_car_t.view(mask_car.shape[1],1)+torch.zeros(self.total_frames)#.to('cuda') #120x12
         '''
         
-        #rescale_xy=torch.ones((1,1,1,2))
-        #rescale_xy[:,:,:,0] = torch.max(abs(self.all_feature[:,:,:,0]))  #121  - test 119.3
-        #rescale_xy[:,:,:,1] = torch.max(abs(self.all_feature[:,:,:,1]))   #77   -  test 79
-        rescale_xy=torch.ones((1,1,1,2))*10
-        self.all_feature[:,:,:now_history_frame+1,:2] = self.all_feature[:,:,:now_history_frame+1,:2]/rescale_xy
-
-        
-        self.node_features = self.all_feature[:,:,:self.history_frames,feature_id]#*mask_car[:,:,:self.history_frames].unsqueeze(-1)  #x,y,heading,vx,vy 5 primeros frames 5s
-        self.node_labels=self.all_feature[:,:,self.history_frames:,[0,1]]#*mask_car[:,:,self.history_frames:].unsqueeze(-1)  #x,y 3 ultimos frames    
-        self.track_info = self.all_feature[:,:,:,info_feats_id]
-        self.output_mask= self.all_feature[:,:,self.history_frames:,-1] ###*mask_car  #mascara only_cars/peds visibles en 6º frame 
-        self.output_mask = self.output_mask.unsqueeze_(-1) #(5010,120,T_hist,1)
-        self.xy_dist=[spatial.distance.cdist(self.node_features[i][:,now_history_frame,:2], self.node_features[i][:,now_history_frame,:2]) for i in range(len(self.all_feature))]  #5010x70x70
-        self.vel_l2 = [spatial.distance.cdist(self.node_features[i][:,now_history_frame,3:5].cpu(), self.node_features[i][:,now_history_frame,3:5].cpu()) for i in range(len(self.all_feature))]
-        
-        id_list = list(set(list(range(total_num))))# - set(zero_indeces_list))
+        id_list = np.arange(total_num)  #ids as int arrays: no per-sequence Python objects copied by the DataLoader workers
         total_valid_num = len(id_list)
         #OPCIÓN A1 / A2
         #self.train_id_list ,self.val_id_list, self.test_id_list = id_list[:round(total_valid_num*0.7)],id_list[round(total_valid_num*0.7):round(total_valid_num*0.9)], id_list[round(total_valid_num*0.9):]
-        #self.test_id_list = list(range(np.where(self.track_info[:,0,0,0]==30)[0][0],total_valid_num))
+        #self.test_id_list = list(range(np.where(self.recording_id==30)[0][0],total_valid_num))
         #id_list = list(set(list(range(total_num))) - set(self.test_id_list))
         #self.train_id_list,self.val_id_list = id_list[:round(total_valid_num*0.8)],id_list[round(total_valid_num*0.8):]
         
@@ -107,100 +114,113 @@ class inD_DGLDataset(torch.utils.data.Dataset):
         if self.train_val == 'test':
             self.test_id_list = id_list
         else:
-            self.val_id_list = list(range(np.where(self.track_info[:,0,0,0]==0)[0][0],np.where(self.track_info[:,0,0,0]==1)[0][0]))
-            self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==7)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==8)[0][0])))
-            self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==18)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==19)[0][0])))
-            self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==30)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==31)[0][0])))
-            self.train_id_list = list(set(id_list)- set(self.val_id_list))
+            self.val_id_list = np.flatnonzero(np.isin(self.recording_id, [0, 7, 18, 30]))
+            self.train_id_list = np.setdiff1d(id_list, self.val_id_list)
 
         '''
         #TEST ROUND
         if self.train_val == 'train':
             self.train_id_list = id_list
         else:
-            self.val_id_list = list(range(np.where(self.track_info[:,0,0,0]==3)[0][0],np.where(self.track_info[:,0,0,0]==6)[0][0]))
-            self.test_id_list = list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==2)[0][0], np.where(self.track_info[:,0,0,0]==3)[0][0]))
-            self.test_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==0)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==1)[0][0])))
+            self.val_id_list = list(np.flatnonzero(np.isin(self.recording_id, [3, 4, 5])))
+            self.test_id_list = list(np.flatnonzero(np.isin(self.recording_id, [0, 2])))
             
         '''
         if self.train_val.lower() == 'train':
-            self.node_features = self.node_features[self.train_id_list]  #frame_id, object_id, object_type, position_x, position_y, position_z, object_length, pbject_width, pbject_height, heading
-            self.node_labels = self.node_labels[self.train_id_list]
-            self.all_adjacency = self.all_adjacency[self.train_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.train_id_list]
-            self.object_type =self.object_type[self.train_id_list]
-            self.output_mask = self.output_mask[self.train_id_list]
-            self.xy_dist = np.array(self.xy_dist)[self.train_id_list]
-            self.vel_l2 = np.array(self.vel_l2)[self.train_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.train_id_list]
+            self.ids = np.array(self.train_id_list)
         elif self.train_val.lower() == 'val':
-            self.node_features = self.node_features[self.val_id_list]
-            self.node_labels = self.node_labels[self.val_id_list]
-            self.all_adjacency = self.all_adjacency[self.val_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.val_id_list]
-            self.object_type =self.object_type[self.val_id_list]
-            self.output_mask = self.output_mask[self.val_id_list]
-            self.xy_dist = np.array(self.xy_dist)[self.val_id_list]
-            self.vel_l2 = np.array(self.vel_l2)[self.val_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.val_id_list]
+            self.ids = np.array(self.val_id_list)
+        else:
+            self.ids = np.array(self.test_id_list)
+
+        # distances are computed only for the edges of each graph, in build_graph
+        self.graphs = None
+        if self.graph_cache and self.model_type != 'hetero':
+            params = {'dataset': 'inD', 'train_val': self.train_val, 'history_frames': self.history_frames, 'future_frames': self.future_frames,
+                      'model_type': self.model_type, 'rel_types': self.types, 'stride': self.stride, 'rel_vels': self.rel_vels}
+            self.graphs = graph_cache.load_or_build(self.raw_dir, params, self.make_graph, len(self.ids))
+
+    def get_sequence(self, seq, with_edges=True):
+        '''
+        Returns feature (V,T,C) with rescaled history positions, edges (src, dst), visible object indexes and mean_xy of sequence seq
+        with_edges=False: src, dst are None and windowed sequences skip the neighbor search
+        '''
+        if self.windowed:
+            rec, start = self.windows[seq]
+            feature, edges, mean_xy, visible_object_idx = graph_utils.window_from_rows(
+                self.all_rows[rec], self.all_track[rec], self.all_frame_offsets[rec], start, 
+                self.history_frames, self.future_frames, distance=self.neighbor_distance, with_edges=with_edges)
+            src, dst = edges[:2] if with_edges else (None, None)
         else:
-            self.node_features = self.node_features[self.test_id_list]
-            self.node_labels = self.node_labels[self.test_id_list]
-            self.all_adjacency = self.all_adjacency[self.test_id_list]
-            self.object_type =self.object_type[self.test_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.test_id_list]
-            self.output_mask = self.output_mask[self.test_id_list]
-            self.xy_dist = np.array(self.xy_dist)[self.test_id_list]
-            self.vel_l2 = np.array(self.vel_l2)[self.test_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.test_id_list]
+            feature = self.all_feature[seq,:,:self.total_frames]
+            src, dst = self.all_edge_src[seq], self.all_edge_dst[seq]
+            mean_xy, visible_object_idx = self.all_mean_xy[seq], self.all_visible_object_idx[seq]
+        feature = torch.from_numpy(np.array(feature)).type(torch.float32) #(V,T,C)
+        #rescale_xy=torch.ones((1,1,2))
+        #rescale_xy[:,:,0] = torch.max(abs(self.all_feature[:,:,:,0]))  #121  - test 119.3
+        #rescale_xy[:,:,1] = torch.max(abs(self.all_feature[:,:,:,1]))   #77   -  test 79
+        rescale_xy=torch.ones((1,1,2))*10
+        feature[:,:self.history_frames,:2] = feature[:,:self.history_frames,:2]/rescale_xy
+        src, dst = (torch.from_numpy(np.array(src)), torch.from_numpy(np.array(dst))) if with_edges else (None, None)
+        return feature, src, dst, np.array(visible_object_idx), mean_xy
 
     def __len__(self):
-            return len(self.node_features)
+            return len(self.ids)
+
+    def object_types(self, feature):
+        object_type = feature[:,:,-2].int()  # torch Tensor VxT
+        object_type[object_type==3] = 1 # truck_bus=1 (car)
+        object_type[object_type==4] = 3 # bic = 3
+        return object_type
+
+    def make_graph(self, idx):
+        feature, edge_src, edge_dst, visible_object_idx, _ = self.get_sequence(self.ids[idx])
+        return self.build_graph(idx, feature, edge_src, edge_dst, visible_object_idx, self.object_types(feature))
 
     def __getitem__(self, idx):
-        graph = dgl.from_scipy(spp.coo_matrix(self.all_adjacency[idx][:len(self.all_visible_object_idx[idx]),:len(self.all_visible_object_idx[idx])])).int()
-        graph = dgl.remove_self_loop(graph)
-        edges_uvs=[np.array([graph.edges()[0][i].numpy(),graph.edges()[1][i].numpy()]) for i in range(graph.num_edges())]
-        rel_types = [(self.object_type[idx][u,self.history_frames-1]* self.object_type[idx][v,self.history_frames-1])for u,v in edges_uvs]
-        graph = dgl.add_self_loop(graph)
-        rel_types.extend(torch.zeros_like(rel_types[0], dtype=torch.float32) for i in range(graph.num_nodes()))
-        feats = self.node_features[idx,self.all_visible_object_idx[idx]] #graph.ndata['x']  (N,Thist,6) - N ~ agents in seq idx = nodes in graph idx
-        gt = self.node_labels[idx,self.all_visible_object_idx[idx]]  #graph.ndata['gt']   (N,Tpred,2)
-        output_mask = self.output_mask[idx,self.all_visible_object_idx[idx]]
-        distances = [self.xy_dist[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        #rel_vels = [self.vel_l2[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        distances = [1/(i) if i!=0 else 1 for i in distances]
-        if self.types:
-            #rel_vels =  F.softmax(torch.tensor(rel_vels, dtype=torch.float32), dim=0)
-            distances = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
-            graph.edata['w'] = torch.tensor([[distances[i],rel_types[i]] for i in range(len(rel_types))], dtype=torch.float32)
-        else:
-            graph.edata['w'] = F.softmax(torch.tensor(distances, dtype=torch.float32), dim=0)
+        seq = self.ids[idx]
+        # with cached graphs only the features are gathered, the edges are already in the graph
+        feature, edge_src, edge_dst, visible_object_idx, mean_xy = self.get_sequence(seq, with_edges=self.graphs is None)
+        object_type = self.object_types(feature)
+        graph = self.graphs[idx] if self.graphs is not None else self.build_graph(idx, feature, edge_src, edge_dst, visible_object_idx, object_type)
+        feats = feature[visible_object_idx][:,:self.history_frames][:,:,self.feature_id] #graph.ndata['x']  (N,Thist,6) - N ~ agents in seq idx = nodes in graph idx
+        gt = feature[visible_object_idx][:,self.history_frames:,:2]  #graph.ndata['gt']   (N,Tpred,2)
+        output_mask = feature[visible_object_idx][:,self.history_frames:,-1:] ###*mask_car  #mascara only_cars/peds visibles en 6º frame 
 
+        if self.test:
+            track_info = feature[visible_object_idx][:,:,self.info_feats_id]
+            object_type = object_type[visible_object_idx,self.history_frames-1]
+            return graph, output_mask, track_info, mean_xy, feats, gt, object_type
+        else: 
+            return graph, output_mask, feats, gt
 
+    def build_graph(self, idx, feature, edge_src, edge_dst, visible_object_idx, object_type):
+        '''
+        Graph of item idx with self-loops and its edge data (w, rel_type and norm for rgcn)
+        '''
+        graph = dgl.graph((edge_src, edge_dst), num_nodes=len(visible_object_idx), idtype=torch.int32)
+        graph = dgl.add_self_loop(graph)  #self-loops go after the edges
+        u, v = graph.edges()
+        u, v = u.long(), v.long()
+        last_type = object_type[:,self.history_frames-1]
+        rel_types = last_type[u] * last_type[v]
+        rel_types[-graph.num_nodes():] = 0  #self-loops
+        distances = utils.edge_inverse_distances(feature[:,self.history_frames-1,:2], u, v)
+        if self.rel_vels:
+            graph.edata['rel_vel'] = F.softmax(utils.edge_inverse_distances(feature[:,self.history_frames-1,3:5], u, v), dim=0)
+        if self.types:
+            distances = F.softmax(distances, dim=0)
+            graph.edata['w'] = torch.stack([distances, rel_types.float()], dim=1)
+        else:
+            graph.edata['w'] = F.softmax(distances, dim=0)
 
         if self.model_type == 'rgcn' or self.model_type == 'hetero':
-            edges_uvs=[np.array([graph.edges()[0][i].numpy(),graph.edges()[1][i].numpy()]) for i in range(graph.num_edges())]
-            rel_types = [self.object_type[idx][u,self.history_frames-1]* self.object_type[idx][v,self.history_frames-1] for u,v in edges_uvs]
-            rel_types = [r - math.ceil(r/2) for r in rel_types] #0: car-car  1:car-ped  2:ped-ped
-            graph.edata['rel_type'] = torch.tensor(rel_types, dtype=torch.uint8)  
-
-            u,v,eid=graph.all_edges(form='all')
-            v_canonical = []
-            v_canonical.append(v[np.where(np.array(rel_types)==0)])
-            v_canonical.append(v[np.where(np.array(rel_types)==1)])
-            v_canonical.append(v[np.where(np.array(rel_types)==2)])
-            ew_canonical = []
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==0)])
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==1)])
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==2)])
-            # calculate norm for each edge type and store in edge
-            graph.edata['norm'] = torch.ones(eid.shape[0],1)  
+            rel_types = last_type[u] * last_type[v]
+            rel_types = rel_types - (rel_types + 1) // 2 #r - ceil(r/2)  0: car-car  1:car-ped  2:ped-ped
+            graph.edata['rel_type'] = rel_types.to(torch.uint8)
             if self.model_type == 'hetero':
-                u_canonical = []
-                u_canonical.append(u[np.where(np.array(rel_types)==0)])
-                u_canonical.append(u[np.where(np.array(rel_types)==1)])
-                u_canonical.append(u[np.where(np.array(rel_types)==2)])
+                u_canonical = [u[rel_types==i] for i in range(3)]
+                v_canonical = [v[rel_types==i] for i in range(3)]
                 graph=dgl.heterograph({
                     ('car', 'v2v', 'car'): (u_canonical[0], v_canonical[0]),
                     ('car', 'v2vru', 'ped'): (u_canonical[1], v_canonical[1]),
@@ -214,21 +234,9 @@ class inD_DGLDataset(torch.utils.data.Dataset):
                     norm = norm.unsqueeze(1)
                     g.edges[etype].data['norm'] = norm
             else:
-                for i,v in enumerate(v_canonical):        
-                    _, inverse_index, count = torch.unique(v, return_inverse=True, return_counts=True)
-                    degrees = count[inverse_index]
-                    norm = torch.ones(v.shape[0]).float() / degrees.float()
-                    norm = norm.unsqueeze(1)
-                    #g.edges[etype].data['norm'] = norm
-                    graph.edata['norm'][np.where(np.array(rel_types)==i)] = norm
-
-        if self.test:
-            mean_xy = self.all_mean_xy[idx]
-            track_info = self.track_info[idx,self.all_visible_object_idx[idx]]
-            object_type = self.object_type[idx,self.all_visible_object_idx[idx],self.history_frames-1]
-            return graph, output_mask, track_info, mean_xy, feats, gt, object_type
-        else: 
-            return graph, output_mask, feats, gt
+                # calculate norm for each edge type and store in edge
+                graph.edata['norm'] = utils.relation_norm(rel_types, v)
+        return graph
 
 if __name__ == "__main__":
     history_frames=8
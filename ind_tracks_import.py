@@ -2,13 +2,37 @@ import pandas
 import glob
 import numpy as np
 import os
-from scipy import spatial 
-import pickle
+import graph_utils
+import geometry
+import data_store
+import argparse
+import multiprocessing
+import time
+import cProfile
+import profiling
 
 
 neighbor_distance = 20
 max_num_object = 70 #per frame
+step = 8 #frames between consecutive windows
+cache_version = 1 #bump when the processing code changes the output, invalidates the cache
 total_feature_dimension = 12 #pos,heading,vel,recording_id,frame,id, l,w, class, mask
+class_mapping = {
+    'car':1,
+    'pedestrian':2,
+    'truck_bus':3, #truck_bus
+    'bicycle':4,
+    #'van': 1,
+    #'motorcycle': 4,
+    #'trailer': 3,
+    #'bus': 3
+}
+# columns of *_tracks.csv that are used, with compact dtypes (positions stay float64, they are zero-centred per sequence later)
+track_columns = {'recordingId': np.int16, 'trackId': np.int32, 'frame': np.int32,
+                 'xCenter': np.float64, 'yCenter': np.float64, 'heading': np.float32,
+                 'width': np.float32, 'length': np.float32, 'xVelocity': np.float32, 'yVelocity': np.float32}
+chunk_size = 200000 #rows of the csv read at once
+profiler = profiling.StageProfiler()
 
 def read_all_recordings_from_csv(base_path="../data/"):
     """
@@ -50,17 +74,22 @@ def read_from_csv(track_file, static_tracks_file, recordings_meta_file):
 
 
 def read_tracks(track_file, static_info):
-    # Read the csv file to a pandas dataframe
-    df = pandas.read_csv(track_file)
-    df_meta = pandas.read_csv(static_info)
+    """
+    This method reads the tracks of a single recording and builds a dense (frame x track) layout of it.
+    :param track_file: The input path for the tracks csv file.
+    :param static_info: The input path for the static tracks csv file.
+    :return: dict with the kept frames, the track ids, a (frame, track) -> row index (-1 if the track is not
+             in that frame) and the per-row feature table (see total_feature_dimension, without the mask)
+    """
+    with profiler.stage('csv read'):
+        df_meta = pandas.read_csv(static_info, usecols=['trackId', 'numFrames', 'class'])
     
     #filter some of the parked vehicles , EXCEPT FOR VISUALIZATION
-    
+    id_parked_objects = []
     if test == False:
         max_num_frames = df_meta['numFrames'].max()
         id_parked_objects = list(df_meta[df_meta['numFrames']==max_num_frames].trackId)
         del id_parked_objects[-10:]  #keep 10 parked cars
-        df = df[~df['trackId'].isin(id_parked_objects)]
         '''
         #filter out no-car or ped objects
         list_car_obj = list(df_meta[df_meta['class']=='car'].trackId)
@@ -69,44 +98,39 @@ def read_tracks(track_file, static_info):
         df = df[df['trackId'].isin(list_car_obj)]   #[~df['trackId'].isin(list_no_car_obj)]
         '''
 
-    # To extract every track, group the rows by the track id
-    raw_tracks = df.groupby(["frame"], sort=True)
-    #ortho_px_to_meter = meta_info["orthoPxToMeter"]
-    tracks = []
-    for frame, track_rows in raw_tracks:
-        track = track_rows.to_dict(orient="list")
-
-        # Convert scalars to single value and lists to numpy arrays
-        for key, value in track.items():
-            if key in ["frame", "track_Lifetime","recordingId"]:
-                track[key] = value[0]
-            else:
-                track[key] = np.array(value)
-
-        track['info_frame'] = np.array((track["recordingId"], track["frame"]))
-        track['info_agent'] = np.stack([track["trackId"],track["length"],track["width"]], axis=-1)
-        track["position"] = np.stack([track["xCenter"], track["yCenter"], np.deg2rad(track["heading"])], axis=-1)
-        track["velocity"] = np.stack([track["xVelocity"], track["yVelocity"]], axis=-1)
-        track["bbox"] = calculate_rotated_bboxes(track["xCenter"], track["yCenter"],
-                                                 track["length"], track["width"],
-                                                 np.deg2rad(track["heading"]))
-        '''
-        # Create special version of some values needed for visualization
-        track["xCenterVis"] = track["xCenter"] / ortho_px_to_meter
-        track["yCenterVis"] = -track["yCenter"] / ortho_px_to_meter
-        track["centerVis"] = np.stack([track["xCenter"], -track["yCenter"]], axis=-1) / ortho_px_to_meter
-        track["widthVis"] = track["width"] / ortho_px_to_meter
-        track["lengthVis"] = track["length"] / ortho_px_to_meter
-        track["headingVis"] = track["heading"] * -1
-        track["headingVis"][track["headingVis"] < 0] += 360
-        track["bboxVis"] = calculate_rotated_bboxes(track["xCenterVis"], track["yCenterVis"],
-                                                    track["lengthVis"], track["widthVis"],
-                                                    np.deg2rad(track["headingVis"]))
-        '''
-        #Keep only frames to 1Hz -> 25 ,  2.5Hz ->10, 1.5 -> 20
-        ratio = 10 if herz==2.5 else 25
-        if frame%ratio == 0:
-            tracks.append(track)
+    #Keep only frames to 1Hz -> 25 ,  2.5Hz ->10, 1.5 -> 20
+    ratio = 10 if herz==2.5 else 25
+
+    # Read the csv in chunks, keeping only the needed columns and frames, so memory is bounded by the kept rows
+    with profiler.stage('csv read'):
+        kept_chunks = []
+        for chunk in pandas.read_csv(track_file, usecols=list(track_columns), dtype=track_columns, chunksize=chunk_size):
+            kept_chunks.append(chunk[(chunk['frame']%ratio == 0) & ~chunk['trackId'].isin(id_parked_objects)])
+        df = pandas.concat(kept_chunks, ignore_index=True)
+
+    with profiler.stage('grouping'):
+        # Dense (frame x track) index: row_index[f, k] is the row of track k in frame f, -1 if it is not there
+        frames, frame_ind = np.unique(df['frame'].values, return_inverse=True)
+        track_ids, track_ind = np.unique(df['trackId'].values, return_inverse=True)
+        row_index = np.full((len(frames), len(track_ids)), -1, dtype=np.int32)
+        row_index[frame_ind, track_ind] = np.arange(len(df))
+
+        object_class = df_meta.set_index('trackId')['class'].replace(class_mapping)
+        #ortho_px_to_meter = meta_info["orthoPxToMeter"]
+        heading = np.deg2rad(df['heading'].values)
+        tracks = {
+            'frame': frames,
+            'trackId': track_ids,
+            'row_index': row_index,
+            # x,y,heading, vx,vy, recording_id,frame, id,l,w, class
+            'feature': np.column_stack([df['xCenter'].values, df['yCenter'].values, heading,
+                                        df['xVelocity'].values, df['yVelocity'].values,
+                                        df['recordingId'].values, df['frame'].values,
+                                        df['trackId'].values, df['length'].values, df['width'].values,
+                                        object_class.loc[df['trackId'].values].values]).astype(float),
+            'bbox': geometry.rotated_box_corners(df['xCenter'].values, df['yCenter'].values,
+                                                 df['length'].values, df['width'].values, heading),
+        }
     return tracks
 
 
@@ -117,20 +141,7 @@ def read_static_info(static_tracks_file):
     :return: the static dictionary - the key is the track_id and the value is the corresponding data for this track
     """
     df = pandas.read_csv(static_tracks_file)
-    mapping_dict={
-        'class':{
-            'car':1,
-            'pedestrian':2,
-            'truck_bus':3, #truck_bus
-            'bicycle':4,
-            #'van': 1,
-            #'motorcycle': 4,
-            #'trailer': 3,
-            #'bus': 3
-        }
-    }
-
-    df=df.replace(mapping_dict)
+    df=df.replace({'class': class_mapping})
 
     return df.to_dict(orient="records")
 
@@ -144,201 +155,165 @@ def read_meta_info(recordings_meta_file):
     return pandas.read_csv(recordings_meta_file).to_dict(orient="records")[0]
 
 
-def calculate_rotated_bboxes(center_points_x, center_points_y, length, width, rotation=0):
-    """
-    Calculate bounding box vertices from centroid, width and length.
-    :param centroid: center point of bbox
-    :param length: length of bbox
-    :param width: width of bbox
-    :param rotation: rotation of main bbox axis (along length)
-    :return:
-    """
-
-    centroid = np.array([center_points_x, center_points_y]).transpose()
-
-    centroid = np.array(centroid)
-    if centroid.shape == (2,):
-        centroid = np.array([centroid])
-
-    # Preallocate
-    data_length = centroid.shape[0]
-    rotated_bbox_vertices = np.empty((data_length, 4, 2))
-
-    # Calculate rotated bounding box vertices
-    rotated_bbox_vertices[:, 0, 0] = -length / 2
-    rotated_bbox_vertices[:, 0, 1] = -width / 2
-
-    rotated_bbox_vertices[:, 1, 0] = length / 2
-    rotated_bbox_vertices[:, 1, 1] = -width / 2
-
-    rotated_bbox_vertices[:, 2, 0] = length / 2
-    rotated_bbox_vertices[:, 2, 1] = width / 2
-
-    rotated_bbox_vertices[:, 3, 0] = -length / 2
-    rotated_bbox_vertices[:, 3, 1] = width / 2
-
-    for i in range(4):
-        th, r = cart2pol(rotated_bbox_vertices[:, i, :])
-        rotated_bbox_vertices[:, i, :] = pol2cart(th + rotation, r).squeeze()
-        rotated_bbox_vertices[:, i, :] = rotated_bbox_vertices[:, i, :] + centroid
-
-    return rotated_bbox_vertices
-
-
-def cart2pol(cart):
-    """
-    Transform cartesian to polar coordinates.
-    :param cart: Nx2 ndarray
-    :return: 2 Nx1 ndarrays
-    """
-    if cart.shape == (2,):
-        cart = np.array([cart])
-
-    x = cart[:, 0]
-    y = cart[:, 1]
-
-    th = np.arctan2(y, x)
-    r = np.sqrt(np.power(x, 2) + np.power(y, 2))
-    return th, r
-
-
-def pol2cart(th, r):
-    """
-    Transform polar to cartesian coordinates.
-    :param th: Nx1 ndarray
-    :param r: Nx1 ndarray
-    :return: Nx2 ndarray
-    """
-
-    x = np.multiply(r, np.cos(th))
-    y = np.multiply(r, np.sin(th))
-
-    cart = np.array([x, y]).transpose()
-    return cart
-
-def process_data(tracks,static_info, start_ind, end_ind, observed_last):
-    #tracks es una lista de dict donde cada fila es un frame
-    #static info es una lista de dict [{column->value},{},...]
-    visible_object_id_list = tracks[observed_last]["trackId"] # object_id appears at the last observed frame
-    #para ver los obj visibles en esa secuencia miramos el final de la sec
-    num_visible_object = visible_object_id_list.size # number of current observed objects
-
-    # compute the mean values of x and y (of all obj detected) for zero-centralization. 
-    visible_object_value = tracks[observed_last]['position']
-    xy = visible_object_value[:, :2].astype(float)   #x,y
-    mean_xy = np.zeros_like(visible_object_value[0], dtype=float)
-    m_xy = np.mean(xy, axis=0)
-    mean_xy[:2] = m_xy
-
-    # compute distance between any pair of two objects
-    dist_xy = spatial.distance.cdist(xy, xy)  #nxn matrix with relative distances
-    # if their distance is less than $neighbor_distance, we regard them are neighbors.
-    neighbor_matrix = np.zeros((max_num_object, max_num_object))
-    neighbor_matrix[:num_visible_object, :num_visible_object] = (dist_xy<neighbor_distance).astype(int)
-
-    now_all_object_id = set([val for frame in range(start_ind, end_ind) for val in tracks[frame]["trackId"]])  #todos los obj en los15 hist frames
-    non_visible_object_id_list = list(now_all_object_id - set(visible_object_id_list))  #obj en alguno de los 15 frames pero no el ultimo
-    num_non_visible_object = len(non_visible_object_id_list)
-
-    # for all history frames or future frames, we only choose the objects listed in visible_object_id_list
-    object_feature_list = []
-    # non_visible_object_feature_list = []
-    for frame_ind in range(start_ind, end_ind):	
-        # we add mark "1" to the end of each row to indicate that this row exists, using list(pra_now_dict[frame_ind][obj_id])+[1] 
-        # -mean_xy is used to zero_centralize data
-        # now_frame_feature_dict = {obj_id : list(pra_now_dict[frame_ind][obj_id]-mean_xy)+[1] for obj_id in pra_now_dict[frame_ind] if obj_id in visible_object_id_list}
-        now_frame_feature_dict = {obj_id : (list(tracks[frame_ind]['position'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])]-mean_xy)+ list(tracks[frame_ind]['velocity'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])]) + list(tracks[frame_ind]['info_frame'])  + list(tracks[frame_ind]['info_agent'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])])+ [static_info[obj_id]['class']] + [1]
-         if obj_id in visible_object_id_list else list(tracks[frame_ind]['position'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])]-mean_xy) + list(tracks[frame_ind]['velocity'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])]) + list(tracks[frame_ind]['info_frame'])  + list(tracks[frame_ind]['info_agent'][int(np.where(tracks[frame_ind]['trackId']==(obj_id))[0])]) + [static_info[obj_id]['class']] + [0]) 
-         for obj_id in tracks[frame_ind]["trackId"] }
-        # if the current object is not at this frame, we return all 0s by using dict.get(_, np.zeros(11))
-        now_frame_feature = np.array([now_frame_feature_dict.get(vis_id, np.zeros(total_feature_dimension)) for vis_id in now_all_object_id])
-        object_feature_list.append(now_frame_feature)
-
-    # object_feature_list has shape of (frame#, object#, 11) 11 = 10features + 1mark
-    object_feature_list = np.array(object_feature_list)
-
-    # object feature with a shape of (frame#, object#, 6) -> (V, T, C)
-    object_frame_feature = np.zeros((max_num_object, end_ind-start_ind, total_feature_dimension))
-    object_frame_feature[:num_visible_object+num_non_visible_object] = np.transpose(object_feature_list, (1,0,2))
-    visible_object_indexes = [list(now_all_object_id).index(i) for i in visible_object_id_list]
-    return object_frame_feature, neighbor_matrix, m_xy, visible_object_indexes
-
 def generate_train_data(file_track_path, file_static_path):
     '''
     Read data from $file_path, and split data into clips with $total_frames length (6+6). 
-    Return: feature and adjacency_matrix
+    Return: feature and edges
         feature: (N, C, T, V) 
             N is the number of sequences in file_path 
             C is the dimension of features, 10raw_feature + 1mark(valid data or not)
             T is the temporal length of the data. history_frames + future_frames
             V is the maximum number of objects. zero-padding for less objects. 
+        edges: (src, dst, distance) of every sequence, between visible objects (graph nodes)
     '''
     tracks = read_tracks(file_track_path,file_static_path)
-    static_info = read_static_info(file_static_path)
-    #maximum_frames = np.max([static_info[track["trackId"]]["finalFrame"] for track in tracks])
-    frame_id_set = list(range(len(tracks))) #list con todos frames
+    frame_id_set = list(range(len(tracks['frame']))) #list con todos frames
 
     all_feature_list = []
-    all_adjacency_list = []
+    all_edges_list = []
     all_mean_list = []
     visible_object_indexes_list=[]
-    step = 8
     for start_ind in frame_id_set[:-total_frames+1:step]:  #[:-total_frames+1:2]#recorre el fichero dividiendo los datos en clips de 8+8 frames a 2.5Hz
         start_ind = int(start_ind)
         end_ind = int(start_ind + total_frames)
         observed_last = start_ind + (history_frames-1)
-        object_frame_feature, neighbor_matrix, mean_xy, visible_object_indexes = process_data(tracks, static_info, start_ind, end_ind, observed_last)  #N=1
+        with profiler.stage('windows'):
+            object_frame_feature, edges, mean_xy, visible_object_indexes = graph_utils.process_data(tracks, start_ind, end_ind, observed_last, 
+                                                                                                    max_num_object, neighbor_distance, profiler)  #N=1
 
         all_feature_list.append(object_frame_feature)
-        all_adjacency_list.append(neighbor_matrix)	
+        all_edges_list.append(edges)
         all_mean_list.append(mean_xy)
         visible_object_indexes_list.append(visible_object_indexes)
 
+    if not all_feature_list:  #recording shorter than total_frames: empty shard, skipped by concat_stores
+        all_feature_list = np.zeros((0, max_num_object, total_frames, tracks['feature'].shape[1]+1))
+        all_mean_list = np.zeros((0, 2))
     # (N, V, T, C) --> (N, C, T, V)
     all_feature_list = np.transpose(all_feature_list, (0, 3, 2, 1))
-    all_adjacency_list = np.array(all_adjacency_list)
     all_mean_list = np.array(all_mean_list)
-    visible_object_indexes_list = np.array(visible_object_indexes_list)
+    visible_object_indexes_list = np.array(visible_object_indexes_list + [None], dtype=object)[:-1]  #ragged
     print(all_feature_list.shape)   #N= nº de secuencias (10 frames) en cada fichero - nºtotal=Nx*nºficheros
-    return all_feature_list, all_adjacency_list, all_mean_list,visible_object_indexes_list
-
-
-def generate_data(file_tracks_list, file_static_list):
-    all_data = []
-    all_adjacency = []
-    all_mean_xy = []
-    all_visible_object_indexes=[]
-
-    for track_file, static_file in zip(file_tracks_list, file_static_list):
-        now_data, now_adjacency, now_mean_xy, now_visible_object_indexes = generate_train_data(track_file,static_file)
-        all_data.extend(now_data)
-        all_adjacency.extend(now_adjacency)
-        all_mean_xy.extend(now_mean_xy)
-        all_visible_object_indexes.extend(now_visible_object_indexes)
-
-    all_data = np.array(all_data) #(N, C, T, V)=(5010, 11, 12, 70) Train
-    all_adjacency = np.array(all_adjacency) #(5010, 70, 70) Train
-    all_mean_xy = np.array(all_mean_xy) #(5010, 2) Train  MEDIAS xy de cada secuencia de 12 frames
-    all_visible_object_indexes = np.array(all_visible_object_indexes)  
-    print(all_data.shape[0])
-    save_path = '/media/14TBDISK/sandra/inD_processed/inD_test_25m.pkl'
-    with open(save_path, 'wb') as writer:
-        pickle.dump([all_data, all_adjacency, all_mean_xy, all_visible_object_indexes], writer)
+    return all_feature_list, all_edges_list, all_mean_list,visible_object_indexes_list
+
+
+def init_worker(params):
+    # Module settings (test, herz, history_frames...) are set in __main__, pass them to the pool processes
+    globals().update(params)
+
+
+def process_recording(track_file, static_file, entry_path):
+    '''
+    Returns the profiler stats of the recording (merged by generate_data, also from pool workers)
+    '''
+    profiler.reset()
+    start = time.perf_counter()
+    now_data, now_edges, now_mean_xy, now_visible_object_indexes = generate_train_data(track_file,static_file)
+    edge_src, edge_dst, edge_dist = zip(*now_edges) if len(now_edges) else ([], [], [])
+    now_data = np.transpose(now_data, (0, 3, 2, 1)) # (N, C, T, V) --> (N, V, T, C) as read by the datasets
+    with profiler.stage('serialization'):
+        data_store.save_store(entry_path,
+                              {'feature': now_data.astype(np.float32),
+                               'mean_xy': now_mean_xy,
+                               'recording_id': now_data[:,:,:,5].max(axis=(1,2)).astype(np.int32)},
+                              ragged={'visible_object_idx': [np.asarray(v, dtype=np.int64) for v in now_visible_object_indexes],
+                                      'edge_src': edge_src, 'edge_dst': edge_dst, 'edge_dist': edge_dist})
+    return recording_stats(track_file, entry_path, len(now_data), start)
+
+
+def recording_stats(track_file, entry_path, num_windows, start):
+    profiler.count('recordings')
+    profiler.count('windows', num_windows)
+    profiler.count('MB cache written', profiling.dir_size_mb(entry_path))
+    print(f'{os.path.basename(track_file)}: {num_windows} windows in {time.perf_counter()-start:.1f}s')
+    return profiler.stats()
+
+
+def process_recording_rows(track_file, static_file, entry_path):
+    '''
+    Stores the recording once as a compact table: one row per (frame, track) present, ordered by frame, 
+    with the track column of each row and the frame offsets into the rows. The datasets cut the 
+    sequences from it at __getitem__ time (see graph_utils.window_from_rows).
+    '''
+    profiler.reset()
+    start = time.perf_counter()
+    tracks = read_tracks(track_file, static_file)
+    present = tracks['row_index'] >= 0
+    frame_offsets = np.zeros(len(present)+1, dtype=np.int64)
+    np.cumsum(present.sum(axis=1), out=frame_offsets[1:])
+    with profiler.stage('serialization'):
+        data_store.save_store(entry_path,
+                              {'recording_id': tracks['feature'][:1,5].astype(np.int32)},
+                              ragged={'feature': [tracks['feature'][tracks['row_index'][present]]],  #(R,11) float64, mean is subtracted per window
+                                      'track': [np.nonzero(present)[1].astype(np.int32)],
+                                      'frame_offsets': [frame_offsets]})
+    return recording_stats(track_file, entry_path, len(range(0, len(present)-total_frames+1, step)), start)
+
+
+def generate_data(file_tracks_list, file_static_list, save_path, workers=1, cache_dir=None, windows=False):
+    '''
+    Process every recording (in parallel if workers > 1) into a cache entry, then merge the entries 
+    in the order of file_tracks_list into the store save_path (see data_store.py).
+    Entries are keyed on the csv contents and the preprocessing parameters, so re-runs only process 
+    the recordings (or parameters) that changed, and an interrupted run resumes where it stopped.
+    windows=False: one entry per sequence (history_frames+future_frames, every step frames).
+    windows=True: one entry per recording (compact rows), sequences of any length/stride are built by the datasets.
+    '''
+    cache_dir = cache_dir or save_path.rstrip('/') + '_cache'
+    params = {name: globals()[name] for name in ['test', 'herz', 'history_frames', 'future_frames', 'total_frames']}
+    meta = dict(params, neighbor_distance=neighbor_distance, max_num_object=max_num_object, step=step, windows=windows)
+    keys = [data_store.cache_key(dict(meta, cache_version=cache_version), [track_file, static_file])
+            for track_file, static_file in zip(file_tracks_list, file_static_list)]
+    entry_paths, missing = data_store.cached_entries(cache_dir, keys)
+    jobs = [(track_file, static_file, entry_path) 
+            for track_file, static_file, entry_path, todo in zip(file_tracks_list, file_static_list, entry_paths, missing) if todo]
+    print(f'{len(jobs)} of {len(entry_paths)} recordings to process, the rest are cached in {cache_dir}')
+    start = time.perf_counter()
+    process = process_recording_rows if windows else process_recording
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(params,)) as pool:
+            all_stats = pool.starmap(process, jobs)
+    else:
+        all_stats = [process(*job) for job in jobs]
+    total = profiling.StageProfiler()
+    for stats in all_stats:
+        total.merge(stats)
+
+    with total.stage('serialization'):
+        data_store.concat_stores(entry_paths, save_path, meta=meta)
+    total.count('MB store written', profiling.dir_size_mb(save_path))  #cache entries are counted apart
+    print(len(data_store.load_store(save_path)['recording_id' if windows else 'feature']))
     print('Data successfully saved.')
+    total.report(time.perf_counter() - start)
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='/media/14TBDISK/inD/test_data/', help='Directory with the *_tracks.csv files')
+    parser.add_argument('--output', type=str, default='/media/14TBDISK/sandra/inD_processed/inD_test_25m', help='Output store directory')
+    parser.add_argument('--workers', type=int, default=1, help='Number of recordings processed in parallel')
+    parser.add_argument('--cache', type=str, default=None, help='Per-recording cache directory (default: <output>_cache)')
+    parser.add_argument('--windows', action='store_true', help='Store each recording once, sequences are built by the datasets')
+    parser.add_argument('--profile', type=str, default=None, help='Dump a cProfile of the run (main process) to this file')
+    args = parser.parse_args()
+
     test = False
     herz = 2.5
     history_frames = 3 if herz==1 else 8 # 5 second * 1 frame/second
     future_frames = 5 if herz==1 else 12 # 5 second * 1 frame/second
     total_frames = history_frames + future_frames
-    input_root_path = '/media/14TBDISK/inD/test_data/'
+    input_root_path = args.input
     tracks_files = sorted(glob.glob(os.path.join(input_root_path , "*_tracks.csv")))
     static_tracks_files = sorted(glob.glob(os.path.join(input_root_path , "*_tracksMeta.csv")))
     recording_meta_files = sorted(glob.glob(os.path.join(input_root_path , "*_recordingMeta.csv")))
-    generate_data(tracks_files, static_tracks_files)
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    generate_data(tracks_files, static_tracks_files, args.output, workers=args.workers, cache_dir=args.cache, windows=args.windows)
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
     
     
     
\ No newline at end of file
@@ -4,6 +4,19 @@ import torch.nn.functional as F
 
 
 
+def map_backbone_channels(backbone, map_channels=None):
+    '''
+    in_channels of the first conv of the map backbone for maps with map_channels channels (nuscenes_Dataset.map_channels).
+    map_encoder and resnet_gray are trained from scratch with any number (1 by default, gray maps),
+    the pretrained resnet and mobilenet only take rgb maps.
+    '''
+    if backbone in ('resnet', 'mobilenet'):
+        if map_channels not in (None, 3):
+            raise ValueError(f'{backbone} is pretrained on rgb maps, use resnet_gray or map_encoder with {map_channels} map channels')
+        return 3
+    return map_channels or 1
+
+
 class My_MapEncoder(nn.Module):
     def __init__(self, input_channels, hidden_channels, input_size, output_size, kernels, strides):
         super(My_MapEncoder, self).__init__()
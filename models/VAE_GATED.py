@@ -10,6 +10,7 @@ from torchvision.models import resnet18
 from NuScenes.nuscenes_Dataset import nuscenes_Dataset, collate_batch
 from torch.utils.data import DataLoader
 from models.VAE_GNN import MLP_Dec, MLP_Enc
+from models.MapEncoder import My_MapEncoder, map_backbone_channels
 
 
 
@@ -115,7 +116,7 @@ class GATED_VAE(nn.Module):
 
 class VAE_GATED(nn.Module):
     def __init__(self, input_dim, hidden_dim, z_dim, output_dim, fc=False, dropout=0.2,  ew_dims=1,  backbone='map_encoder', freeze=6,
-                    bn=False, gn=False):
+                    bn=False, gn=False, map_channels=None):
         super().__init__()
         self.fc = fc
         self.z_dim = z_dim
@@ -125,8 +126,9 @@ class VAE_GATED(nn.Module):
         ###############
         # Map Encoder #
         ###############
+        in_channels = map_backbone_channels(backbone, map_channels)
         if backbone == 'map_encoder':
-            self.feature_extractor = My_MapEncoder(input_channels = 1, input_size=112, 
+            self.feature_extractor = My_MapEncoder(input_channels = in_channels, input_size=112, 
                                                     hidden_channels = [10,32,64,128,256], output_size = hidden_dim, 
                                                     kernels = [5,5,3,3,3], strides = [1,2,2,2,2])
             enc_dims = hidden_dim*2+output_dim    
@@ -150,7 +152,7 @@ class VAE_GATED(nn.Module):
             resnet = resnet18(pretrained=False)
             modules = list(resnet.children())[:-3]
             modules.append(torch.nn.AdaptiveAvgPool2d((1, 1))) 
-            modules[0] = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3,bias=False)  #stride=1 if list[:-1]
+            modules[0] = nn.Conv2d(in_channels, 64, kernel_size=7, stride=2, padding=3,bias=False)  #stride=1 if list[:-1]
             nn.init.kaiming_normal_(modules[0].weight, mode='fan_out', nonlinearity='relu')
             self.feature_extractor=torch.nn.Sequential(*modules)   
             enc_dims = hidden_dim + output_dim + 256
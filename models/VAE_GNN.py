@@ -9,7 +9,7 @@ import matplotlib.pyplot as plt
 from torchvision.models import resnet18
 from NuScenes.nuscenes_Dataset import nuscenes_Dataset, collate_batch
 from torch.utils.data import DataLoader
-from models.MapEncoder import My_MapEncoder
+from models.MapEncoder import My_MapEncoder, map_backbone_channels
 from models.scout import My_GATLayer, MultiHeadGATLayer
 from torchsummary import summary
 
@@ -102,7 +102,7 @@ class GAT_VAE(nn.Module):
 class VAE_GNN(nn.Module):
     def __init__(self, input_dim, hidden_dim, z_dim, output_dim, fc=False, dropout=0.2, feat_drop=0., 
                     attn_drop=0., heads=1,att_ew=False, ew_dims=1, backbone='map_encoder', freeze=6,
-                    bn=False, gn=False):
+                    bn=False, gn=False, map_channels=None):
         super().__init__()
         self.heads = heads
         self.fc = fc
@@ -113,8 +113,9 @@ class VAE_GNN(nn.Module):
         ###############
         # Map Encoder #
         ###############
+        in_channels = map_backbone_channels(backbone, map_channels)
         if backbone == 'map_encoder':
-            self.feature_extractor = My_MapEncoder(input_channels = 1, input_size=112, 
+            self.feature_extractor = My_MapEncoder(input_channels = in_channels, input_size=112, 
                                                     hidden_channels = [16,32,32,40], output_size = hidden_dim, 
                                                     kernels = [5,5,3,3], strides = [1,2,2,2])
             enc_dims = hidden_dim*2+output_dim    
@@ -141,7 +142,7 @@ class VAE_GNN(nn.Module):
             resnet = resnet18(pretrained=False)
             modules = list(resnet.children())[:-3]
             modules.append(torch.nn.AdaptiveAvgPool2d((1, 1))) 
-            modules[0] = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3,bias=False)  #stride=1 if list[:-1]
+            modules[0] = nn.Conv2d(in_channels, 64, kernel_size=7, stride=2, padding=3,bias=False)  #stride=1 if list[:-1]
             nn.init.kaiming_normal_(modules[0].weight, mode='fan_out', nonlinearity='relu')
             self.feature_extractor=torch.nn.Sequential(*modules)   
             enc_dims = hidden_dim + output_dim + 256
@@ -15,7 +15,7 @@ from torch.utils.data import DataLoader
 from NuScenes.nuscenes_Dataset import nuscenes_Dataset, collate_batch
 from torchvision.models import resnet18, mobilenet_v2
 from torchsummary import summary
-from models.MapEncoder import My_MapEncoder
+from models.MapEncoder import My_MapEncoder, map_backbone_channels
 
 class GATConv(nn.Module):
     def __init__(self,
@@ -205,7 +205,7 @@ class SCOUT(nn.Module):
     
     def __init__(self, input_dim, hidden_dim, output_dim, dropout=0.2, bn=False, gn=False, 
                 feat_drop=0., attn_drop=0., heads=1,att_ew=False, res_weight=True, 
-                res_connection=True, ew_type=False,  backbone='mobilenet', freeze=0):
+                res_connection=True, ew_type=False,  backbone='mobilenet', freeze=0, map_channels=None):
         super().__init__()
 
         self.heads = heads
@@ -222,8 +222,9 @@ class SCOUT(nn.Module):
         # Map Encoder #
         ###############
         
+        in_channels = map_backbone_channels(backbone, map_channels)
         if backbone == 'map_encoder':            
-            self.feature_extractor = My_MapEncoder(input_channels = 1, input_size=112, 
+            self.feature_extractor = My_MapEncoder(input_channels = in_channels, input_size=112, 
                                                     hidden_channels = [10,32,64,128,256], output_size = hidden_dim, 
                                                     kernels = [5,5,3,3,3], strides = [1,2,2,2,2])
             hidden_dims = hidden_dim*2
@@ -265,7 +266,7 @@ class SCOUT(nn.Module):
             resnet = resnet18(pretrained=False)
             modules = list(resnet.children())[:-3]
             modules.append(torch.nn.AdaptiveAvgPool2d((1, 1))) 
-            modules[0] = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3,bias=False)
+            modules[0] = nn.Conv2d(in_channels, 64, kernel_size=7, stride=2, padding=3,bias=False)
             nn.init.kaiming_normal_(modules[0].weight, mode='fan_out', nonlinearity='relu')
             self.feature_extractor=torch.nn.Sequential(*modules)   
             hidden_dims = hidden_dim + 256
@@ -0,0 +1,70 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+'''
+Stage timing for the preprocessing scripts.
+    with profiler.stage('csv read'): ...      #time of nested stages is not counted twice
+    profiler.count('windows', n)
+Workers of a multiprocessing pool return profiler.stats() and the main process merges them.
+'''
+
+
+class StageProfiler:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)  #exclusive time of each stage
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(float)
+        self._children = []  #time spent in nested stages, one entry per open stage
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._children.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self._children.pop()
+            self.calls[name] += 1
+            if self._children:
+                self._children[-1] += elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def stats(self):
+        return {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+    def merge(self, stats):
+        for name, value in stats['seconds'].items():
+            self.seconds[name] += value
+        for name, value in stats['calls'].items():
+            self.calls[name] += value
+        for name, value in stats['counters'].items():
+            self.counters[name] += value
+
+    def report(self, wall_time, items='windows'):
+        '''
+        Prints the time per stage (summed over workers, so it can exceed the wall time) and the throughput.
+        '''
+        total = sum(self.seconds.values()) or 1.
+        print(f"{'stage':<20}{'calls':>8}{'seconds':>12}{'%':>8}")
+        for name, value in sorted(self.seconds.items(), key=lambda kv: -kv[1]):
+            print(f"{name:<20}{self.calls[name]:>8}{value:>12.2f}{100*value/total:>8.1f}")
+        print(f"{'counter':<20}{'total':>20}")
+        for name, value in self.counters.items():
+            print(f"{name:<20}{value:>20.1f}")
+        # cache entries (MB cache written) and the merged output store (MB store written) are reported apart:
+        # on a cold run the data is written twice, once per entry and once merged
+        print(f"wall time {wall_time:.1f}s, {self.counters[items]/max(wall_time, 1e-9):.1f} {items}/s, "
+              f"{self.counters['MB store written']/max(wall_time, 1e-9):.1f} MB/s store, "
+              f"{self.counters['MB cache written']/max(wall_time, 1e-9):.1f} MB/s cache")
+
+
+def dir_size_mb(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) / 1e6
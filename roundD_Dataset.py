@@ -9,10 +9,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import os
+import data_store
+import graph_utils
+import graph_cache
 import utils
 os.environ['DGLBACKEND'] = 'pytorch'
 from torchvision import datasets, transforms
-import scipy.sparse as spp
 from dgl.data import DGLDataset
 from sklearn.preprocessing import StandardScaler
 
@@ -52,7 +54,7 @@ def collate_batch(samples):
 
 class roundD_DGLDataset(torch.utils.data.Dataset):
 
-    def __init__(self, train_val, history_frames, future_frames, test=False, model_type='gat', data_path=None, classes=(1,2,3,4,5,6,7,8)):
+    def __init__(self, train_val, history_frames, future_frames, test=False, model_type='gat', data_path=None, classes=(1,2,3,4,5,6,7,8), stride=None, graph_cache=False):
         
         self.history_frames = history_frames
         self.future_frames = future_frames
@@ -61,145 +63,165 @@ class roundD_DGLDataset(torch.utils.data.Dataset):
         self.model_type = model_type
         self.test = test
         self.classes = classes
+        self.stride = stride  #only for stores of recordings (ind_tracks_import.py --windows), default: step of the preprocessing
+        self.graph_cache = graph_cache  #build the graphs once (graph_cache.py) and load them in __getitem__
 
         if self.total_frames == 16:
-            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_8f.pkl' 
+            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_8f' #store dir, see data_store.py
             #if self.train_val != 'train':
-            #    self.raw_dir_train='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz_3s5s_nofilter.pkl'
+            #    self.raw_dir_train='/media/14TBDISK/sandra/inD_processed/inD_2.5Hz_3s5s_nofilter'
         elif self.total_frames == 20:
-            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_12f.pkl' 
+            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_12f' 
 
         if test:
-            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_12f.pkl' 
+            self.raw_dir_train='/media/14TBDISK/sandra/rounD_processed/rounD_2.5Hz8_12f' 
+        if data_path is not None:
+            self.raw_dir_train = data_path
         
         self.process()        
 
     def load_data(self):
-        with open(self.raw_dir_train, 'rb') as reader:
-            [all_feature_train, self.all_adjacency, self.all_mean_xy, self.all_visible_object_idx]= pickle.load(reader)
-        all_feature_train=np.transpose(all_feature_train, (0,3,2,1)) #(N,V,T,C)
-        self.all_feature_train=torch.from_numpy(all_feature_train[:,:,:self.total_frames,:]).type(torch.float32)
+        # memory-mapped, sequences are read in __getitem__ (store shared with the other splits)
+        store = data_store.shared_store(self.raw_dir_train)
+        self.windowed = store['meta'].get('windows', False)
+        if self.windowed:
+            # one entry per recording, the sequences are cut in __getitem__ for any history/future/stride
+            self.all_rows = store['feature']
+            self.all_track = store['track']
+            self.all_frame_offsets = store['frame_offsets']
+            self.neighbor_distance = store['meta']['neighbor_distance']
+            stride = self.stride or store['meta']['step']
+            self.windows = np.array([(rec, start) for rec in range(len(self.all_rows)) 
+                                     for start in range(0, len(self.all_frame_offsets[rec])-self.total_frames, stride)], dtype=int).reshape(-1,2)
+            self.recording_id = np.asarray(store['recording_id'])[self.windows[:,0]]
+            self.num_sequences = len(self.windows)
+            return
+        self.all_feature_train = store['feature'] #(N,V,T,C)
+        self.all_edge_src = store['edge_src']  #graph edges (sparse, no self-loops)
+        self.all_edge_dst = store['edge_dst']
+        self.all_mean_xy = store['mean_xy']
+        self.all_visible_object_idx = store['visible_object_idx']
+        self.recording_id = store['recording_id']
+        self.num_sequences = len(self.all_feature_train)
 
 
     def process(self):
         self.load_data()
         
-        total_num = len(self.all_feature_train)
+        total_num = self.num_sequences
         now_history_frame=self.history_frames-1
-        feature_id = [0,1,3,4,2,10] #pos  vel heading type 
-        info_feats_id = list(range(5,11))  #recording_id,frame,id, l,w, class
+        self.feature_id = [0,1,3,4,2,10] #pos  vel heading type 
+        self.info_feats_id = list(range(5,11))  #recording_id,frame,id, l,w, class
         
         if self.model_type == 'grip':
-            feature_id = [0,1,2,-1]
+            self.feature_id = [0,1,2,-1]
         
-        self.object_type = self.all_feature_train[:,:,:,-2].int()  # torch Tensor NxVxT
         #mask_car=torch.zeros((total_num,self.all_feature_train.shape[1],self.total_frames)).to('cuda') #NxVx10
         #for i in range(total_num):
         #    mask_car_t=torch.Tensor([1 if j in self.classes else 0 for j in self.object_type[i,:,now_history_frame]]).to('cuda')
         #    mask_car[i,:]=mask_car_t.view(mask_car.shape[1],1)+torch.zeros(self.total_frames).to('cuda') #120x12
-
-
-        #self.all_feature[:,:,:now_history_frame,3:5] = self.all_feature[:,:,:now_history_frame,3:5]/rescale_xy
-        self.node_features = self.all_feature_train[:,:,:self.history_frames,feature_id]#*mask_car[:,:,:self.history_frames].unsqueeze(-1)  #x,y,heading,vx,vy 5 primeros frames 5s
-        self.node_labels=self.all_feature_train[:,:,self.history_frames:,:2]#*mask_car[:,:,self.history_frames:].unsqueeze(-1)  #x,y 3 ultimos frames    
-        self.output_mask= self.all_feature_train[:,:,:,-1]#*mask_car #mascara obj (car) visibles en 6º frame (5010,120,T_hist)
-        self.output_mask = self.output_mask.unsqueeze_(-1) #(5010,120,T_hist,1)
-        self.xy_dist=[spatial.distance.cdist(self.node_features[i][:,now_history_frame,:2].cpu(), self.node_features[i][:,now_history_frame,:2].cpu()) for i in range(len(self.all_feature_train))]  #5010x70x70
-        #self.vel_l2 = [spatial.distance.cdist(self.node_features[i][:,now_history_frame,-2:].cpu(), self.node_features[i][:,now_history_frame,-2:].cpu()) for i in range(len(self.all_feature_train))]
-        self.track_info = self.all_feature_train[:,:,:,info_feats_id].detach().cpu().numpy()
         #self.object_type *= mask_car.int() #Keep only v2v v2vru vru2vru rel-types
 
-        id_list = list(set(list(range(total_num))))# - set(zero_indeces_list))
+        id_list = np.arange(total_num)  #ids as int arrays: no per-sequence Python objects copied by the DataLoader workers
         total_valid_num = len(id_list)
         #B: self.test_id_list, self.val_id_list, self.train_id_list = id_list[:round(total_valid_num*0.1)],id_list[round(total_valid_num*0.1):round(total_valid_num*0.3)],id_list[round(total_valid_num*0.3):]
         #A: self.train_id_list, self.val_id_list, self.test_id_list = id_list[:round(total_valid_num*0.7)],id_list[round(total_valid_num*0.7):round(total_valid_num*0.9)],id_list[round(total_valid_num*0.9):]
         
         #CONVENTIONAL
-        self.val_id_list = list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==4)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==6)[0][0]))
-        self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==12)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==14)[0][0])))
-        self.test_id_list = list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==2)[0][0],np.where(self.track_info[:,0,self.history_frames-1,0]==4)[0][0] )) #list(range(np.where(self.track_info[:,0,0,0]==16)[0][0], np.where(self.track_info[:,0,0,0]==20)[0][0]))  #scenario 16-19
-        self.train_id_list = list(set(id_list) - set( self.val_id_list) - set(self.test_id_list))
+        self.val_id_list = np.flatnonzero(np.isin(self.recording_id, [4, 5, 12, 13]))
+        self.test_id_list = np.flatnonzero(np.isin(self.recording_id, [2, 3])) #list(np.flatnonzero(np.isin(self.recording_id, [16, 17, 18, 19])))  #scenario 16-19
+        self.train_id_list = np.setdiff1d(id_list, np.concatenate([self.val_id_list, self.test_id_list]))
         '''VAL TEST EN IND
         self.train_id_list = id_list
         if self.train_val != 'train':
-            self.val_id_list = list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==0)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==2)[0][0]))
-            self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==18)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==20)[0][0])))
-            self.val_id_list.extend(list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==30)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==31)[0][0])))
-            self.test_id_list = list(range(np.where(self.track_info[:,0,self.history_frames-1,0]==7)[0][0], np.where(self.track_info[:,0,self.history_frames-1,0]==9)[0][0]))
+            self.val_id_list = list(np.flatnonzero(np.isin(self.recording_id, [0, 1, 18, 19, 30])))
+            self.test_id_list = list(np.flatnonzero(np.isin(self.recording_id, [7, 8])))
         '''
         if self.test:
-            self.test_id_list = list(range(np.where(self.track_info[:,0,0,0]==0)[0][0],np.where(self.track_info[:,0,0,0]==1)[0][0] ))
+            self.test_id_list = np.flatnonzero(self.recording_id == 0)
 
         if self.train_val.lower() == 'train':
-            self.node_features = self.node_features[self.train_id_list]  #frame_id, object_id, object_type, position_x, position_y, position_z, object_length, pbject_width, pbject_height, heading
-            self.node_labels = self.node_labels[self.train_id_list]
-            self.all_adjacency = self.all_adjacency[self.train_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.train_id_list]
-            self.output_mask = self.output_mask[self.train_id_list]
-            self.xy_dist = torch.tensor(self.xy_dist)[self.train_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.train_id_list]
+            self.ids = np.array(self.train_id_list)
         elif self.train_val.lower() == 'val':
-            self.node_features = self.node_features[self.val_id_list]
-            self.node_labels = self.node_labels[self.val_id_list]
-            self.all_adjacency = self.all_adjacency[self.val_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.val_id_list]
-            self.output_mask = self.output_mask[self.val_id_list]
-            self.xy_dist = np.array(self.xy_dist)[self.val_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.val_id_list]
+            self.ids = np.array(self.val_id_list)
+        else:
+            self.ids = np.array(self.test_id_list)
+
+        # distances are computed only for the edges of each graph, in build_graph
+
+        self.graphs = None
+        if self.graph_cache and self.model_type != 'hetero':
+            params = {'dataset': 'rounD', 'train_val': self.train_val, 'test': self.test, 'history_frames': self.history_frames,
+                      'future_frames': self.future_frames, 'model_type': self.model_type, 'stride': self.stride}
+            self.graphs = graph_cache.load_or_build(self.raw_dir_train, params, self.make_graph, len(self.ids))
+
+    def get_sequence(self, seq, with_edges=True):
+        '''
+        Returns feature (V,T,C), edges (src, dst), visible object indexes and mean_xy of sequence seq
+        with_edges=False: src, dst are None and windowed sequences skip the neighbor search
+        '''
+        if self.windowed:
+            rec, start = self.windows[seq]
+            feature, edges, mean_xy, visible_object_idx = graph_utils.window_from_rows(
+                self.all_rows[rec], self.all_track[rec], self.all_frame_offsets[rec], start, 
+                self.history_frames, self.future_frames, distance=self.neighbor_distance, with_edges=with_edges)
+            src, dst = edges[:2] if with_edges else (None, None)
         else:
-            self.node_features = self.node_features[self.test_id_list]
-            self.node_labels = self.node_labels[self.test_id_list]
-            self.all_adjacency = self.all_adjacency[self.test_id_list]
-            self.all_mean_xy = self.all_mean_xy[self.test_id_list]
-            self.output_mask = self.output_mask[self.test_id_list]
-            self.xy_dist = np.array(self.xy_dist)[self.test_id_list]
-            self.all_visible_object_idx = self.all_visible_object_idx[self.test_id_list]
+            feature = self.all_feature_train[seq,:,:self.total_frames]
+            src, dst = self.all_edge_src[seq], self.all_edge_dst[seq]
+            mean_xy, visible_object_idx = self.all_mean_xy[seq], self.all_visible_object_idx[seq]
+        feature = torch.from_numpy(np.array(feature)).type(torch.float32) #(V,T,C)
+        src, dst = (torch.from_numpy(np.array(src)), torch.from_numpy(np.array(dst))) if with_edges else (None, None)
+        return feature, src, dst, np.array(visible_object_idx), mean_xy
         
  
     def __len__(self):
-        return len(self.all_adjacency)
+        return len(self.ids)
         
     def __getitem__(self, idx):
         
-        track_info = self.track_info[idx,self.all_visible_object_idx[idx]]
+        seq = self.ids[idx]
+        # with cached graphs only the features are gathered, the edges are already in the graph
+        feature, edge_src, edge_dst, visible_object_idx, mean_xy = self.get_sequence(seq, with_edges=self.graphs is None)
+        track_info = feature[visible_object_idx][:,:,self.info_feats_id].numpy()
+        graph = self.graphs[idx] if self.graphs is not None else self.build_graph(idx, feature, edge_src, edge_dst, visible_object_idx)
 
-        graph = dgl.from_scipy(spp.coo_matrix(self.all_adjacency[idx][:len(self.all_visible_object_idx[idx]),:len(self.all_visible_object_idx[idx])])).int()
-        graph = dgl.remove_self_loop(graph)
-        graph = dgl.add_self_loop(graph)
+        feats = feature[visible_object_idx][:,:self.history_frames][:,:,self.feature_id] #graph.ndata['x']
+        gt = feature[visible_object_idx][:,self.history_frames:,:2]  #graph.ndata['gt']
+        output_mask = feature[visible_object_idx][:,:,-1:]  #mascara obj (car) visibles en 6º frame (V,T,1)
 
-        feats = self.node_features[idx,self.all_visible_object_idx[idx]] #graph.ndata['x']
-        gt = self.node_labels[idx,self.all_visible_object_idx[idx]]  #graph.ndata['gt']
-        output_mask = self.output_mask[idx,self.all_visible_object_idx[idx]]
+        if self.test:
+            return graph, output_mask, track_info, mean_xy, feats, gt, track_info[:,self.history_frames-1,5]
 
-        distances = [self.xy_dist[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        #rel_vels = [self.vel_l2[idx][graph.edges()[0][i]][graph.edges()[1][i]] for i in range(graph.num_edges())]
-        #rel_vels = [1/(i) if i!=0 else 1 for i in rel_vels]          
-        distances = [1/(i) if i!=0 else 1 for i in distances]
-        norm_distances = [(i-min(distances))/(max(distances)-min(distances)) if (max(distances)-min(distances))!=0 else (i-min(distances))/1.0 for i in distances]
-        graph.edata['w'] = torch.tensor(distances, dtype=torch.float32)
+        else: 
+            return graph, output_mask, feats, gt
+
+    def make_graph(self, idx):
+        feature, edge_src, edge_dst, visible_object_idx, _ = self.get_sequence(self.ids[idx])
+        return self.build_graph(idx, feature, edge_src, edge_dst, visible_object_idx)
+
+    def build_graph(self, idx, feature, edge_src, edge_dst, visible_object_idx):
+        '''
+        Graph of item idx with self-loops and its edge data (w, rel_type and norm for rgcn)
+        '''
+        object_type = feature[:,:,-2].int()  # torch Tensor VxT
+        graph = dgl.graph((edge_src, edge_dst), num_nodes=len(visible_object_idx), idtype=torch.int32)
+        graph = dgl.add_self_loop(graph)
+
+        u, v = graph.edges()
+        u, v = u.long(), v.long()
+        distances = utils.edge_inverse_distances(feature[:,self.history_frames-1,:2], u, v)
+        #rel_vels = utils.edge_inverse_distances(feature[:,self.history_frames-1,3:5], u, v)
+        graph.edata['w'] = distances
 
         if self.model_type == 'rgcn' or self.model_type == 'hetero':
-            edges_uvs=[np.array([graph.edges()[0][i].numpy(),graph.edges()[1][i].numpy()]) for i in range(graph.num_edges())]
-            rel_types = [self.object_type[idx][u,self.history_frames-1]* self.object_type[idx][v,self.history_frames-1] for u,v in edges_uvs]
-            rel_types = [r - math.ceil(r/2) for r in rel_types] #0: car-car  1:car-ped  2:ped-ped
-            graph.edata['rel_type'] = torch.tensor(rel_types, dtype=torch.uint8)  
-
-            u,v,eid=graph.all_edges(form='all')
-            v_canonical = []
-            v_canonical.append(v[np.where(np.array(rel_types)==0)])
-            v_canonical.append(v[np.where(np.array(rel_types)==1)])
-            v_canonical.append(v[np.where(np.array(rel_types)==2)])
-            ew_canonical = []
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==0)])
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==1)])
-            ew_canonical.append(graph.edata['w'][np.where(np.array(rel_types)==2)])
-            # calculate norm for each edge type and store in edge
-            graph.edata['norm'] = torch.ones(eid.shape[0],1)  
+            last_type = object_type[:,self.history_frames-1]
+            rel_types = last_type[u] * last_type[v]
+            rel_types = rel_types - (rel_types + 1) // 2 #r - ceil(r/2)  0: car-car  1:car-ped  2:ped-ped
+            graph.edata['rel_type'] = rel_types.to(torch.uint8)
             if self.model_type == 'hetero':
-                u_canonical = []
-                u_canonical.append(u[np.where(np.array(rel_types)==0)])
-                u_canonical.append(u[np.where(np.array(rel_types)==1)])
-                u_canonical.append(u[np.where(np.array(rel_types)==2)])
+                u_canonical = [u[rel_types==i] for i in range(3)]
+                v_canonical = [v[rel_types==i] for i in range(3)]
                 graph=dgl.heterograph({
                     ('car', 'v2v', 'car'): (u_canonical[0], v_canonical[0]),
                     ('car', 'v2vru', 'ped'): (u_canonical[1], v_canonical[1]),
@@ -213,20 +235,9 @@ class roundD_DGLDataset(torch.utils.data.Dataset):
                     norm = norm.unsqueeze(1)
                     g.edges[etype].data['norm'] = norm
             else:
-                for i,v in enumerate(v_canonical):        
-                    _, inverse_index, count = torch.unique(v, return_inverse=True, return_counts=True)
-                    degrees = count[inverse_index]
-                    norm = torch.ones(v.shape[0]).float() / degrees.float()
-                    norm = norm.unsqueeze(1)
-                    #g.edges[etype].data['norm'] = norm
-                    graph.edata['norm'][np.where(np.array(rel_types)==i)] = norm
-
-        if self.test:
-            mean_xy = self.all_mean_xy[idx]
-            return graph, output_mask, track_info, mean_xy, feats, gt, track_info[:,self.history_frames-1,5]
-
-        else: 
-            return graph, output_mask, feats, gt
+                # calculate norm for each edge type and store in edge
+                graph.edata['norm'] = utils.relation_norm(rel_types, v)
+        return graph
 
 if __name__ == "__main__":
     history_frames=3
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# los modulos del repo son scripts sueltos, no un paquete
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'NuScenes'))
+
+# dataroot with v1.0-mini for the nuScenes tests, skipped when not set
+NUSCENES_DATAROOT = os.environ.get('NUSCENES_DATAROOT')
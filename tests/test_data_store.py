@@ -0,0 +1,64 @@
+import json
+import numpy as np
+import data_store
+
+
+def write_store(path, feature):
+    data_store.save_store(str(path), {'feature': feature}, ragged={'edge_src': [np.arange(3), np.arange(1)]}, meta={'history_frames': 8})
+
+
+def test_store_digest_changes_with_the_data(tmp_path):
+    write_store(tmp_path / 'store', np.zeros((2, 4)))
+    digest = data_store.store_digest(str(tmp_path / 'store'))
+    write_store(tmp_path / 'store', np.zeros((2, 4)))
+    assert data_store.store_digest(str(tmp_path / 'store')) == digest
+    write_store(tmp_path / 'store', np.ones((2, 4)))  #same fields and meta, other contents
+    assert data_store.store_digest(str(tmp_path / 'store')) != digest
+
+
+def test_store_digest_of_concatenated_stores(tmp_path):
+    write_store(tmp_path / 'a', np.zeros((2, 4)))
+    write_store(tmp_path / 'b', np.ones((2, 4)))
+    data_store.concat_stores([str(tmp_path / 'a'), str(tmp_path / 'b')], str(tmp_path / 'all'))
+    digest = data_store.store_digest(str(tmp_path / 'all'))
+    write_store(tmp_path / 'b', np.full((2, 4), 2.))
+    data_store.concat_stores([str(tmp_path / 'a'), str(tmp_path / 'b')], str(tmp_path / 'all'))
+    assert data_store.store_digest(str(tmp_path / 'all')) != digest
+
+
+def test_store_digest_without_digest_in_the_index(tmp_path):
+    # stores written before the digest was saved in the index
+    write_store(tmp_path / 'store', np.zeros((2, 4)))
+    index_path = tmp_path / 'store' / data_store.INDEX_FILE
+    index = json.loads(index_path.read_text())
+    digest = index.pop('digest')
+    index_path.write_text(json.dumps(index))
+    assert data_store.store_digest(str(tmp_path / 'store')) == digest
+
+
+def test_pack_ragged():
+    seqs = [np.array([[1, 2]]), np.zeros((0, 2)), np.array([[3, 4], [5, 6]])]
+    values, offsets = data_store.pack_ragged(seqs)
+    np.testing.assert_array_equal(offsets, [0, 1, 1, 3])
+    ragged = data_store.Ragged(values, offsets)
+    assert len(ragged) == 3
+    for a, b in zip(ragged, seqs):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_concat_stores_shifts_ids(tmp_path):
+    shards = [[['a', 'b'], ['b']], [['c'], [], ['a', 'c', 'd']]]  #token strings of each sequence, per shard
+    for i, seqs in enumerate(shards):
+        table, ids = data_store.intern(np.concatenate([np.array(s, dtype='U1') for s in seqs]))
+        _, offsets = data_store.pack_ragged(seqs)
+        data_store.save_store(str(tmp_path / str(i)), {'token_table': table, 'first': ids[np.minimum(offsets[:-1], len(ids)-1)]},
+                              ragged={'tokens': [ids[offsets[j]:offsets[j+1]] for j in range(len(seqs))]})
+    data_store.concat_stores([str(tmp_path / str(i)) for i in range(len(shards))], str(tmp_path / 'all'),
+                             id_fields={'tokens': 'token_table', 'first': 'token_table'})
+    store = data_store.load_store(str(tmp_path / 'all'))
+    seqs = [s for shard in shards for s in shard]
+    assert len(store['tokens']) == len(seqs)
+    for i, seq in enumerate(seqs):
+        assert list(store['token_table'][store['tokens'][i]]) == seq
+        if seq:
+            assert store['token_table'][store['first'][i]] == seq[0]
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+dgl = pytest.importorskip('dgl')
+import data_store
+import graph_cache
+
+
+def test_rebuilt_store_invalidates_the_graph_cache(tmp_path):
+    raw_dir = str(tmp_path / 'store')
+    params = {'history_frames': 8}
+
+    def build(num_nodes):
+        data_store.save_store(raw_dir, {'num_nodes': np.array([num_nodes])})
+        build_graph = lambda idx: dgl.graph((torch.arange(num_nodes), torch.arange(num_nodes)), idtype=torch.int32)
+        return graph_cache.load_or_build(raw_dir, params, build_graph, 1)
+
+    assert build(3)[0].num_nodes() == 3
+    assert build(5)[0].num_nodes() == 5  #same params, new contents: not served from the old cache
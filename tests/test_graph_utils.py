@@ -0,0 +1,118 @@
+import numpy as np
+from scipy import spatial
+import graph_utils
+
+
+def random_tracks(rng, num_frames=40, num_tracks=12, num_features=6):
+    # read_tracks layout: row_index (frames x tracks, -1 if absent) + feature table of the rows
+    present = rng.random((num_frames, num_tracks)) < 0.6
+    present[:, 0] = True  #at least one object visible at every frame
+    row_index = np.full(present.shape, -1, dtype=np.int32)
+    row_index[present] = np.arange(present.sum())
+    feature = rng.uniform(-50, 50, (present.sum(), num_features))
+    return {'row_index': row_index, 'feature': feature}
+
+
+def old_process_data(frames, start_ind, end_ind, observed_last, num_objects, feature_dimension):
+    # per-object dict comprehension of the original ind_tracks_import.process_data, frames[i] = {'trackId', 'feature'}
+    visible_object_id_list = frames[observed_last]['trackId']
+    xy = frames[observed_last]['feature'][:, :2]
+    mean_xy = np.zeros(feature_dimension-1)
+    m_xy = np.mean(xy, axis=0)
+    mean_xy[:2] = m_xy
+    now_all_object_id = set([val for frame in range(start_ind, end_ind) for val in frames[frame]['trackId']])
+    object_feature_list = []
+    for frame_ind in range(start_ind, end_ind):
+        now_frame_feature_dict = {obj_id : list(frames[frame_ind]['feature'][np.where(frames[frame_ind]['trackId']==(obj_id))[0][0]]-mean_xy) + [1 if obj_id in visible_object_id_list else 0]
+                                  for obj_id in frames[frame_ind]['trackId']}
+        object_feature_list.append(np.array([now_frame_feature_dict.get(vis_id, np.zeros(feature_dimension)) for vis_id in now_all_object_id]))
+    object_frame_feature = np.zeros((num_objects, end_ind-start_ind, feature_dimension))
+    object_frame_feature[:len(now_all_object_id)] = np.transpose(np.array(object_feature_list), (1,0,2))
+    visible_object_indexes = [list(now_all_object_id).index(i) for i in visible_object_id_list]
+    return object_frame_feature, m_xy, list(now_all_object_id), visible_object_indexes
+
+
+def test_process_data_matches_old_dict_comprehension():
+    rng = np.random.default_rng(3)
+    tracks = random_tracks(rng)
+    frames = [{'trackId': np.flatnonzero(rows >= 0), 'feature': tracks['feature'][rows[rows >= 0]]} for rows in tracks['row_index']]
+    num_objects, feature_dimension = 20, tracks['feature'].shape[1] + 1
+    for start_ind in range(0, 28, 4):
+        end_ind, observed_last = start_ind + 12, start_ind + 4
+        feature, _, m_xy, visible = graph_utils.process_data(tracks, start_ind, end_ind, observed_last, num_objects, 25)
+        old_feature, old_m_xy, old_ids, old_visible = old_process_data(frames, start_ind, end_ind, observed_last, num_objects, feature_dimension)
+        np.testing.assert_allclose(m_xy, old_m_xy)
+
+        # same objects, the visible ones first (node i of the graph is object i), then the rest by track id
+        visible_ids = frames[observed_last]['trackId']
+        ids = np.concatenate([visible_ids, np.setdiff1d(old_ids, visible_ids)])
+        assert visible == list(range(len(visible_ids)))
+        assert [old_ids[i] for i in old_visible] == list(visible_ids)
+        old_order = [old_ids.index(i) for i in ids]
+        np.testing.assert_allclose(feature[:len(ids)], old_feature[old_order])  #features and visible mark (last column)
+        assert not feature[len(ids):].any()
+
+
+def compact_rows(tracks):
+    # process_recording_rows layout: rows ordered by frame, track of each row and offsets of each frame
+    frame, track = np.nonzero(tracks['row_index'] >= 0)
+    rows = tracks['feature'][tracks['row_index'][frame, track]]
+    frame_offsets = np.searchsorted(frame, np.arange(len(tracks['row_index']) + 1))
+    return rows, track, frame_offsets
+
+
+def test_window_from_rows_matches_process_data():
+    rng = np.random.default_rng(2)
+    history_frames, future_frames, distance = 5, 7, 40
+    tracks = random_tracks(rng)
+    rows, track, frame_offsets = compact_rows(tracks)
+    for start_ind in range(0, len(tracks['row_index']) - history_frames - future_frames + 1, 3):
+        end_ind = start_ind + history_frames + future_frames
+        feature, edges, mean_xy, visible = graph_utils.process_data(tracks, start_ind, end_ind, start_ind + history_frames - 1,
+                                                                    tracks['row_index'].shape[1], distance)
+        window = graph_utils.window_from_rows(rows, track, frame_offsets, start_ind, history_frames, future_frames, distance)
+        num_objects = len(window[0])
+        np.testing.assert_array_equal(window[0], feature[:num_objects])
+        assert not feature[num_objects:].any()  #padding only
+        for a, b in zip(window[1], edges):
+            np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_equal(window[2], mean_xy)
+        assert window[3] == visible
+
+
+def dense_neighbors(xy, distance):
+    # old neighbor search: VxV cdist matrix, self-loops removed
+    adjacency = (spatial.distance.cdist(xy, xy) < distance) & ~np.eye(len(xy), dtype=bool)
+    return np.nonzero(adjacency)
+
+
+def test_neighbor_edges_matches_dense_adjacency():
+    rng = np.random.default_rng(0)
+    for num_nodes in [1, 2, 30, 200]:
+        xy = rng.uniform(0, 100, (num_nodes, 2))
+        src, dst, dist = graph_utils.neighbor_edges(xy, 25)
+        dense_src, dense_dst = dense_neighbors(xy, 25)
+        np.testing.assert_array_equal(src, dense_src)
+        np.testing.assert_array_equal(dst, dense_dst)
+        np.testing.assert_allclose(dist, np.linalg.norm(xy[src] - xy[dst], axis=-1), rtol=1e-6)
+
+
+def test_neighbor_edges_radii_per_class():
+    rng = np.random.default_rng(1)
+    xy = rng.uniform(0, 100, (100, 2))
+    types = rng.integers(1, 3, 100)
+    src, dst, _ = graph_utils.neighbor_edges(xy, 10, types=types, radii={(1, 2): 30})
+    radius = np.where(types[:, None] != types[None, :], 30, 10)
+    adjacency = (spatial.distance.cdist(xy, xy) < radius) & ~np.eye(len(xy), dtype=bool)
+    np.testing.assert_array_equal(np.stack([src, dst]), np.stack(np.nonzero(adjacency)))
+
+
+def test_window_from_rows_without_edges():
+    # graph_cache: the datasets only gather the features, the edges come from the cached graph
+    rng = np.random.default_rng(4)
+    rows, track, frame_offsets = compact_rows(random_tracks(rng))
+    window = graph_utils.window_from_rows(rows, track, frame_offsets, 6, 5, 7, 40)
+    features_only = graph_utils.window_from_rows(rows, track, frame_offsets, 6, 5, 7, 40, with_edges=False)
+    assert features_only[1] is None
+    np.testing.assert_array_equal(features_only[0], window[0])
+    assert features_only[3] == window[3]
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import data_store
+import ind_tracks_import
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    # module settings are set in __main__ (see init_worker)
+    for name, value in dict(test=False, herz=2.5, history_frames=8, future_frames=12, total_frames=20).items():
+        monkeypatch.setattr(ind_tracks_import, name, value, raising=False)
+
+
+def fake_tracks(num_frames, recording_id, num_tracks=5):
+    rng = np.random.default_rng(recording_id)
+    row_index = np.arange(num_frames*num_tracks, dtype=np.int32).reshape(num_frames, num_tracks)
+    feature = rng.uniform(0, 30, (num_frames*num_tracks, 11))
+    feature[:, 5] = recording_id
+    return {'frame': np.arange(num_frames), 'trackId': np.arange(num_tracks), 'row_index': row_index, 'feature': feature}
+
+
+def test_short_recording_gives_an_empty_shard(tmp_path, settings, monkeypatch):
+    lengths = {'short': 19, 'long': 40}  #total_frames = 20
+    monkeypatch.setattr(ind_tracks_import, 'read_tracks', lambda track_file, static_file: fake_tracks(lengths[track_file], len(track_file)))
+    for name in ['short', 'long']:
+        ind_tracks_import.process_recording(name, None, str(tmp_path / name))
+    assert len(data_store.load_store(str(tmp_path / 'short'))['feature']) == 0
+
+    data_store.concat_stores([str(tmp_path / 'short'), str(tmp_path / 'long')], str(tmp_path / 'all'))
+    store, long = data_store.load_store(str(tmp_path / 'all')), data_store.load_store(str(tmp_path / 'long'))
+    assert len(store['feature']) == len(long['feature']) > 0
+    np.testing.assert_array_equal(store['edge_src'].values, long['edge_src'].values)
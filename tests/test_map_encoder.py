@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip('torch')
+from models.MapEncoder import map_backbone_channels
+
+
+def test_map_backbone_channels():
+    assert map_backbone_channels('resnet_gray') == map_backbone_channels('map_encoder') == 1  #gray maps
+    assert map_backbone_channels('map_encoder', 5) == map_backbone_channels('resnet_gray', 5) == 5  #masks encoding
+    assert map_backbone_channels('resnet', 3) == map_backbone_channels('mobilenet') == 3
+    with pytest.raises(ValueError):
+        map_backbone_channels('resnet', 5)
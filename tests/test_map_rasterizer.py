@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('nuscenes')
+from conftest import NUSCENES_DATAROOT
+
+pytestmark = pytest.mark.skipif(NUSCENES_DATAROOT is None, reason='NUSCENES_DATAROOT (v1.0-mini) not set')
+
+# the cached image is a resampled approximation of the devkit one: pixels differ along polygon and lane borders
+MIN_AGREEMENT = 0.95   #fraction of pixels whose rgb matches within COLOR_TOLERANCE
+COLOR_TOLERANCE = 16   #per channel, lane colors come from the yaw of the nearest lane pose
+
+
+def test_cached_rasterizer_agrees_with_devkit():
+    import devkit
+    import map_rasterizer
+    from nuscenes.prediction.input_representation.static_layers import StaticLayerRasterizer
+    helper = devkit.get_helper(version='v1.0-mini', dataroot=NUSCENES_DATAROOT)
+    devkit_rasterizer = StaticLayerRasterizer(helper)
+    cached_rasterizer = map_rasterizer.CachedStaticLayerRasterizer(helper)
+
+    nuscenes = helper.data
+    sample = nuscenes.get('sample', nuscenes.scene[0]['first_sample_token'])
+    for token in sample['anns'][:5]:
+        instance = nuscenes.get('sample_annotation', token)['instance_token']
+        expected = devkit_rasterizer.make_representation(instance, sample['token'])
+        image = cached_rasterizer.make_representation(instance, sample['token'])
+        assert image.shape == expected.shape
+        close = (np.abs(image.astype(int) - expected.astype(int)) <= COLOR_TOLERANCE).all(-1)
+        assert close.mean() >= MIN_AGREEMENT, (token, close.mean())
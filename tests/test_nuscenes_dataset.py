@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('dgl')
+pytest.importorskip('sklearn')
+from nuscenes_Dataset import nuscenes_Dataset
+
+
+def test_old_pickle_asks_to_rerun_the_preprocessing(tmp_path):
+    (tmp_path / 'nuscenes_step2_seq_val.pkl').write_bytes(b'')
+    dataset = nuscenes_Dataset.__new__(nuscenes_Dataset)
+    dataset.raw_dir = str(tmp_path / 'nuscenes_step2_seq_val')
+    with pytest.raises(FileNotFoundError, match='old pickle format.*nuscenes_process.py'):
+        dataset.load_data()
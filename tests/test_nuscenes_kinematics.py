@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('nuscenes')
+from conftest import NUSCENES_DATAROOT
+
+pytestmark = pytest.mark.skipif(NUSCENES_DATAROOT is None, reason='NUSCENES_DATAROOT (v1.0-mini) not set')
+
+
+@pytest.fixture(scope='module')
+def process():
+    import nuscenes_process
+    nuscenes_process.VERSION, nuscenes_process.DATAROOT = 'v1.0-mini', NUSCENES_DATAROOT
+    nuscenes_process.devkit_index_path = None
+    return nuscenes_process
+
+
+def scene_samples(nuscenes, scene):
+    tokens, token = [], scene['first_sample_token']
+    while token:
+        tokens.append(token)
+        token = nuscenes.get('sample', token)['next']
+    return tokens
+
+
+def test_scene_kinematics_matches_predict_helper(process):
+    nuscenes, helper = process.get_nuscenes(), process.get_helper()
+    sample_tokens = scene_samples(nuscenes, nuscenes.scene[0])
+    kinematics = process.scene_kinematics(sample_tokens)
+    checked = 0
+    for sample_token in sample_tokens:
+        for token in nuscenes.get('sample', sample_token)['anns']:
+            annotation = nuscenes.get('sample_annotation', token)
+            velocity, acceleration, heading_change_rate = kinematics[token]
+            instance = annotation['instance_token']
+            # velocity: the devkit returns the speed, we keep the vector
+            np.testing.assert_allclose(np.linalg.norm(velocity), helper.get_velocity_for_agent(instance, sample_token), rtol=1e-6, equal_nan=True)
+            np.testing.assert_allclose(heading_change_rate, helper.get_heading_change_rate_for_agent(instance, sample_token), rtol=1e-6, atol=1e-9, equal_nan=True)
+            # acceleration: the devkit one is the difference of speeds, not |acceleration vector|
+            expected = helper.get_acceleration_for_agent(instance, sample_token)
+            if not np.isnan(expected):
+                prev = nuscenes.get('sample_annotation', annotation['prev'])
+                time_diff = 1e-6 * (nuscenes.get('sample', sample_token)['timestamp'] - nuscenes.get('sample', prev['sample_token'])['timestamp'])
+                speed_diff = np.linalg.norm(velocity) - np.linalg.norm(kinematics[prev['token']][0])
+                np.testing.assert_allclose(speed_diff / time_diff, expected, rtol=1e-6, atol=1e-9)
+                checked += 1
+    assert checked > 0
@@ -0,0 +1,13 @@
+import profiling
+
+
+def test_report_keeps_cache_and_store_apart(capsys):
+    profiler = profiling.StageProfiler()
+    worker = profiling.StageProfiler()
+    worker.count('windows', 10)
+    worker.count('MB cache written', 3.)
+    profiler.merge(worker.stats())
+    profiler.count('MB store written', 3.)
+    profiler.report(1.)
+    out = capsys.readouterr().out
+    assert '3.0 MB/s store' in out and '3.0 MB/s cache' in out
@@ -0,0 +1,40 @@
+import math
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from scipy import spatial
+import utils
+
+
+def random_graph(rng, num_nodes=25):
+    # edges of neighbor_edges plus self-loops, as the datasets build them
+    src, dst = np.nonzero(rng.random((num_nodes, num_nodes)) < 0.3)
+    src, dst = np.concatenate([src, np.arange(num_nodes)]), np.concatenate([dst, np.arange(num_nodes)])
+    return src, dst
+
+
+def test_edge_inverse_distances_matches_old_loop():
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 50, (25, 2))
+    xy[3] = xy[4]  #distance 0 between two different nodes
+    src, dst = random_graph(rng)
+    xy_dist = spatial.distance.cdist(xy, xy)
+    distances = [xy_dist[u][v] for u, v in zip(src, dst)]
+    expected = torch.tensor([1/(i) if i!=0 else 1 for i in distances], dtype=torch.float32)
+    torch.testing.assert_close(utils.edge_inverse_distances(xy, src, dst), expected)
+
+
+def test_relation_norm_matches_old_loop():
+    rng = np.random.default_rng(1)
+    src, dst = random_graph(rng)
+    object_type = rng.integers(1, 3, 25)  #1: car, 2: ped
+    rel_types = [object_type[u]*object_type[v] for u, v in zip(src, dst)]
+    rel_types = [r - math.ceil(r/2) for r in rel_types]  #0: car-car  1:car-ped  2:ped-ped
+    v = torch.from_numpy(dst)
+    expected = torch.ones(len(dst), 1)
+    for i in range(3):
+        v_i = v[np.where(np.array(rel_types)==i)]
+        _, inverse_index, count = torch.unique(v_i, return_inverse=True, return_counts=True)
+        expected[np.where(np.array(rel_types)==i)] = (torch.ones(v_i.shape[0]).float() / count[inverse_index].float()).unsqueeze(1)
+    torch.testing.assert_close(utils.relation_norm(torch.tensor(rel_types), dst), expected)
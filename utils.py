@@ -61,3 +61,24 @@ def compute_long_lat_error(pred,gt,mask):
     return lateral_error, long_error, overall_num
 
 
+
+
+def edge_inverse_distances(points, src, dst):
+    '''
+    1/distance of every edge (1 for distance 0, e.g. self-loops), computed only for the edges instead of a VxV cdist matrix.
+    :points: (V,D) node positions (or any vector, e.g. velocities) at the last observed frame
+    :src, dst: edge node ids, e.g. graph.edges()
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    distances = np.sqrt(((points[np.asarray(src, dtype=np.int64)] - points[np.asarray(dst, dtype=np.int64)])**2).sum(-1))
+    return torch.from_numpy(np.where(distances != 0, 1 / np.where(distances != 0, distances, 1), 1)).float()
+
+
+def relation_norm(rel_types, dst, num_types=3):
+    '''
+    rgcn edge norm: 1/in-degree of the destination node counting only edges of the same relation type (types < num_types, 1 otherwise)
+    '''
+    rel_types, dst = torch.as_tensor(rel_types).long(), torch.as_tensor(dst).long()
+    _, inverse_index, count = torch.unique(rel_types * (int(dst.max()) + 1 if len(dst) else 1) + dst, return_inverse=True, return_counts=True)
+    norm = 1. / count[inverse_index].float()
+    return torch.where(rel_types < num_types, norm, torch.ones_like(norm)).unsqueeze(1)